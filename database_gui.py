@@ -9,6 +9,7 @@ import numpy as np
 import threading
 import queue
 from refractivesqlite import dboperations as DB
+from refractivesqlite.material import tabulated_dispersion
 import matplotlib.pyplot as plt
 import numpy as np
 from pyterminal.terminal_frame import TerminalFrame
@@ -204,7 +205,6 @@ class RefrectiveIndexHandler(object):
         self.wavelength = None
         self.gvd = None
         self.name = None
-        self.c0 = 3e8
         if id is not None:
             self.get_data_from_id(id)
 
@@ -219,8 +219,13 @@ class RefrectiveIndexHandler(object):
             self.k = var2[:, 1]
         else:
             self.k = None
-        wav2, gvd_res = self.calculate_gvd(self.wavelength, self.n)
-        self.gvd = gvd_res
+        dispersion = db.get_dispersion(id)
+        if dispersion is not None and len(dispersion.gvd) == len(self.n):
+            # Precomputed when the database was built with dispersion=True
+            self.gvd = np.array(dispersion.gvd)
+        else:
+            wav2, gvd_res = self.calculate_gvd(self.wavelength, self.n)
+            self.gvd = gvd_res
 
     def get_data_from_info(self, data):
         id = int(data[0])
@@ -234,21 +239,10 @@ class RefrectiveIndexHandler(object):
             ref = (ref - np.roll(ref, 1)) / (l - np.roll(l, 1))
         return np.array([l[order:], ref[order:]]).T
 
-    def second_der(self, l, ref):
-        var1 = np.roll(ref, -1) - 2 * ref + np.roll(ref, 1)
-        var2 = l - np.roll(l, 1)
-        res = var1 / var2 ** 2
-        res[0] = np.nan
-        res[-1] = np.nan
-        return np.array([l, res]).T
-
     def calculate_gvd(self, l, ref):
-        der_sol = self.second_der(l, ref)
-        lambda0 = der_sol[:, 0]
-        der_1 = der_sol[:, 1]
-        res = lambda0 ** 3 / (2 * np.pi * self.c0 ** 2) * der_1
-        res = res * 1e21
-        return lambda0, res
+        # Local cubic fits handle the non-uniform wavelength grids of the database
+        dispersion = tabulated_dispersion(l, ref)
+        return dispersion.wavelength, dispersion.gvd
 
     def __repr__(self):
         return 'RefractiveIndexHandler Object at '+hex(id(self))+ \
@@ -316,18 +310,10 @@ class WholeDatabaseFrame(tk.Toplevel):
         self.result_tree.bind("<Button-1>", delayed_click)
 
         shelf_list = ['main', 'organic', 'glass', 'other', '3d']
+        hierarchy = db.get_page_hierarchy(shelf=shelf_list)
         for shelf in shelf_list:
-            main = db.search_custom("SELECT * FROM pages WHERE shelf LIKE '" + shelf + "'")
-
-            set_of_books = set()
-
-            for el in main:
-                set_of_books.add(el[2])
-
             x1 = self.result_tree.insert('', 'end', text=shelf, values=())
-            for book in set_of_books:
-                s_res = db.search_custom(
-                    "SELECT * FROM pages WHERE shelf LIKE '" + shelf + "' and book like '" + book + "'")
+            for book, s_res in hierarchy.get(shelf, {}).items():
                 if len(s_res) > 1:
                     y1 = self.result_tree.insert(x1, 'end', text=book, values=())
                     for i, res in enumerate(s_res):
@@ -337,7 +323,7 @@ class WholeDatabaseFrame(tk.Toplevel):
                 else:
                     res = s_res[0]
                     self.result_tree.insert(x1, 'end', text='', values=(
-                    res[2], res[3], res[7], res[8], ('No', 'Yes')[res[6]], res[8], res[0]))
+                    res[2], res[3], res[7], res[8], ('No', 'Yes')[res[6]], res[9], res[0]))
 
     def click_event(self, event):
         selection_list = self.result_tree.selection()
@@ -456,19 +442,11 @@ class SearchFrame(tk.Frame):
             self.result_tree.delete(*self.result_tree.get_children())
             return
 
-        stlist = search_term.split(' ')
         search_area = self.search_combo.value()
         if exact_bool:
-            sql_query = "SELECT * FROM pages WHERE " + search_area + " like '" + search_term + "'"
-            self.search_res = db.search_custom(sql_query)
+            self.search_res = db.query_pages(**{search_area: search_term})
         else:
-            self.search_res = []
-            for sterm in stlist:
-                if sterm == '':
-                    continue
-                sql_query = "SELECT * FROM pages WHERE " + search_area + " like '%" + sterm + "%'"
-                search_res_small = db.search_custom(sql_query)
-                self.search_res.extend(search_res_small)
+            self.search_res = db.search_fulltext(search_term, columns=[search_area])
 
         # self.search_res = db.search_pages(search_term,exact=True)
         self.update_tree()
@@ -1,57 +1,227 @@
 from collections import namedtuple,OrderedDict
+import hashlib
+import itertools
+import json
 import os
 import yaml
 import sqlite3
+import threading
+import weakref
 import numpy as np
 
 from refractivesqlite import material
-from refractivesqlite.material import Material
+from refractivesqlite.material import Material, YamlLoader
 
 Shelf = namedtuple('Shelf', ['shelf', 'name'])
 Book = namedtuple('Book', ['book', 'name'])
-Page = namedtuple('Page', ['page', 'name', 'path'])
+# path is the absolute path of the page file, source the path as listed in library.yml.
+Page = namedtuple('Page', ['page', 'name', 'path', 'source'])
 Entry = namedtuple('Entry',['id','shelf','book','page'])
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'materials', 'nbytes', 'maxbytes'])
 
 _riiurl = "http://refractiveindex.info/download/database/rii-database-2016-01-31.zip"
 
 class Database:
+    """Read access to a refractiveindex.info SQLite database.
 
-    def __init__(self, sqlitedbpath):
+    Every thread gets one connection that stays open until the thread exits or
+    the object is closed, so repeated lookups pay the connect cost once and the statement
+    cache of the connection is reused. Use it as a context manager or call
+    :meth:`close` to release the connections.
+
+    Loaded materials are kept in an LRU cache of about ``cache_bytes`` bytes
+    (0 disables it), which is dropped when the database file changes on disk.
+    Cached Material objects are shared between callers. The budget counts the data
+    and the lookup caches (interpolators, derivatives, dispersion) of a material.
+    These grow after it is handed out, so a material is measured again on every cache
+    hit and all of them on cache_info.
+    """
+
+    def __init__(self, sqlitedbpath, cached_statements=128, cache_bytes=64 * 2 ** 20):
         if not os.path.isfile(sqlitedbpath):
             raise Exception('Database file not found')
         self.db_path = sqlitedbpath
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        # Facts about the file resolved once, reset together with the material cache.
+        self._blob_storage = None
+        self._page_columns = None
+        self._fulltext = None
+        self._resampled = None
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_nbytes = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_signature = self._file_signature()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the connections of all threads."""
+        with self._connections_lock:
+            for holder in list(self._connections):
+                holder.close()
+            self._connections = weakref.WeakSet()
+            self._local = threading.local()
+
+    def _connection(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = _ThreadConnection(sqlite3.connect(self.db_path, check_same_thread=False,
+                                                       cached_statements=self.cached_statements))
+            with self._connections_lock:
+                self._connections.add(holder)
+                self._local.holder = holder
+        return holder.conn
+
+    def _query(self, sqlquery, parameters=()):
+        c = self._connection().execute(sqlquery, parameters)
+        results = c.fetchall()
+        c.close()
+        return results
+
+    def _file_signature(self):
+        stat = os.stat(self.db_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def cache_info(self):
+        with self._cache_lock:
+            for pageid in list(self._cache):
+                self._remeasure(pageid)
+            self._evict()
+            return CacheInfo(self._cache_hits, self._cache_misses, len(self._cache), self._cache_nbytes,
+                             self.cache_bytes)
 
-    def create_database_from_folder(self, yml_database_path, interpolation_points=100):
-        create_sqlite_database(yml_database_path, self.db_path,interpolation_points=interpolation_points)
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_nbytes = 0
+            self._cache_signature = self._file_signature()
+            self._blob_storage = None
+            self._page_columns = None
+            self._fulltext = None
+            self._resampled = None
 
-    def create_database_from_url(self,interpolation_points=100,riiurl=_riiurl):
+    def _cache_get(self, pageid):
+        signature = self._file_signature()
+        with self._cache_lock:
+            if signature != self._cache_signature:
+                self._cache.clear()
+                self._cache_nbytes = 0
+                self._cache_signature = signature
+                self._blob_storage = None
+                self._page_columns = None
+                self._fulltext = None
+                self._resampled = None
+            entry = self._cache.get(pageid)
+            if entry is None:
+                self._cache_misses += 1
+                return None
+            self._cache_hits += 1
+            self._cache.move_to_end(pageid)
+            self._remeasure(pageid)
+            self._evict()
+            return entry[0]
+
+    def _remeasure(self, pageid):
+        # Called with the cache lock held.
+        mat, nbytes = self._cache[pageid]
+        current = _material_nbytes(mat)
+        self._cache[pageid] = (mat, current)
+        self._cache_nbytes += current - nbytes
+
+    def _evict(self):
+        # Called with the cache lock held.
+        while self._cache_nbytes > self.cache_bytes:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cache_nbytes -= evicted
+
+    def _cache_put(self, pageid, mat):
+        nbytes = _material_nbytes(mat)
+        with self._cache_lock:
+            if nbytes > self.cache_bytes or pageid in self._cache:
+                return
+            self._cache[pageid] = (mat, nbytes)
+            self._cache_nbytes += nbytes
+            self._evict()
+
+    def create_database_from_folder(self, yml_database_path, interpolation_points=100, storage='rows', workers=1,
+                                    dispersion=False):
+        self.close()
+        create_sqlite_database(yml_database_path, self.db_path,interpolation_points=interpolation_points,
+                               storage=storage, workers=workers, dispersion=dispersion)
+        self.clear_cache()
+
+    def update_from_folder(self, yml_database_path, interpolation_points=100, workers=1):
+        self.close()
+        result = update_sqlite_database(yml_database_path, self.db_path, interpolation_points=interpolation_points,
+                                        workers=workers)
+        self.clear_cache()
+        return result
+
+    def upgrade(self):
+        """Add the primary key and indexes to a database file from an older version."""
+        self.close()
+        result = upgrade_sqlite_database(self.db_path)
+        self.clear_cache()
+        return result
+
+    def resample(self, points=1000, wavelength_min=None, wavelength_max=None):
+        """Store all pages on a shared wavelength grid, see :func:`resample_sqlite_database`."""
+        self.close()
+        resample_sqlite_database(self.db_path, points=points, wavelength_min=wavelength_min,
+                                 wavelength_max=wavelength_max)
+        self.clear_cache()
+
+    def get_resampled(self):
+        """The ResampledTable of the database or None if :meth:`resample` was never run on it."""
+        if self._file_signature() != self._cache_signature:
+            self.clear_cache()
+        if self._resampled is None:
+            try:
+                results = self._query('SELECT dtype, wmin, wmax, points, pageids, refindex, coeff FROM resampled')
+            except sqlite3.OperationalError:
+                results = []
+            if len(results) == 0:
+                return None
+            dtype, wmin, wmax, points, pageids, refindex, coeff = results[0]
+            pageids = np.frombuffer(pageids, dtype='<i8')
+            self._resampled = ResampledTable(np.geomspace(wmin, wmax, points), pageids,
+                                             _unpack_array(refindex, dtype).reshape(len(pageids), points),
+                                             _unpack_array(coeff, dtype).reshape(len(pageids), points))
+        return self._resampled
+
+    def create_database_from_url(self,interpolation_points=100,riiurl=_riiurl,storage='rows',workers=1,
+                                 dispersion=False):
         Database.DownloadRIIzip(riiurl=riiurl)
-        self.create_database_from_folder("database", interpolation_points=interpolation_points)
+        self.create_database_from_folder("database", interpolation_points=interpolation_points, storage=storage,
+                                         workers=workers, dispersion=dispersion)
         pass
 
     def check_url_version(self):
         print(_riiurl)
 
-    def search_custom(self,sqlquery):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(sqlquery)
-        results = c.fetchall()
+    def search_custom(self,sqlquery,parameters=()):
+        results = self._query(sqlquery,parameters)
         # if len(results)==0:
         #     print("No results found.")
         # else:
         #     print(len(results),"results found.")
-        conn.close()
         return results
 
     def search_pages(self,term="",exact=False):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         if not exact:
-            c.execute('SELECT * FROM pages WHERE shelf like ? or book like ? or page like ? or filepath like ?', ["%"+term+"%" for i in range(4)])
+            results = self._query('SELECT * FROM pages WHERE shelf like ? or book like ? or page like ? or filepath like ?', ["%"+term+"%" for i in range(4)])
         else:
-            c.execute('SELECT * FROM pages WHERE shelf like ? or book like ? or page like ? or filepath like ?', [term for i in range(4)])
-        results = c.fetchall()
+            results = self._query('SELECT * FROM pages WHERE shelf like ? or book like ? or page like ? or filepath like ?', [term for i in range(4)])
         # if len(results)==0:
         #     print("No results found.")
         # else:
@@ -60,9 +230,76 @@ class Database:
         #     print("\t".join(columns))
         #     for r in results:
         #         print("\t".join(map(str,r[:])))
-        conn.close()
         return results
 
+    def query_pages(self, shelf=None, book=None, page=None, covers=None, has_refractive=None,
+                    has_extinction=None, exact=True):
+        """Pages matching all given filters, in library order.
+
+        The query only uses bound parameters, so it is prepared once per connection.
+
+        :param shelf: name or list of names, compared case insensitive with LIKE
+            (substring match with exact=False); the same for book and page
+        :param covers: (min, max) wavelength interval in um the data has to cover
+        :param has_refractive: True/False to require pages with/without n data
+        :param has_extinction: True/False to require pages with/without k data
+        :return: list of pages rows like search_pages
+        """
+        where, parameters = _page_filters(shelf, book, page, covers, has_refractive, has_extinction, exact)
+        return self._query('SELECT * FROM pages' + where + ' ORDER BY pageid', parameters)
+
+    def get_page_hierarchy(self, **filters):
+        """Pages grouped as shelf -> book -> list of pages rows with a single query.
+
+        Takes the filters of :meth:`query_pages`.
+        """
+        hierarchy = OrderedDict()
+        for row in self.query_pages(**filters):
+            hierarchy.setdefault(row[1], OrderedDict()).setdefault(row[2], []).append(row)
+        return hierarchy
+
+    def search_fulltext(self, term, columns=None, match_all=False, limit=None):
+        """Ranked search for whitespace separated terms in the page names.
+
+        Every term matches the start of a word in shelf, book, page or filepath (or only in
+        ``columns``). With match_all=False pages matching any term are returned, pages
+        matching more of them first. Every page is returned once. Databases without the
+        full-text index fall back to LIKE queries.
+
+        :return: list of pages rows like search_pages
+        """
+        terms = term.split()
+        columns = list(columns or _fulltext_columns)
+        for column in columns:
+            if column not in _fulltext_columns:
+                raise ValueError('columns must be in ' + ', '.join(_fulltext_columns))
+        if len(terms) == 0:
+            return []
+        if not self._has_fulltext():
+            return self._search_like(terms, columns, match_all, limit)
+        phrases = ['"' + t.replace('"', '""') + '"*' for t in terms]
+        query = '{' + ' '.join(columns) + '} : (' + (' AND ' if match_all else ' OR ').join(phrases) + ')'
+        return self._query('''SELECT p.* FROM pages_fts f JOIN pages p ON p.pageid = f.rowid
+                    WHERE pages_fts MATCH ? ORDER BY f.rank LIMIT ?''', [query, -1 if limit is None else limit])
+
+    def _search_like(self, terms, columns, match_all, limit):
+        where = " or ".join(column + " like ?" for column in columns)
+        matches = OrderedDict()
+        counts = {}
+        for t in terms:
+            for row in self._query('SELECT * FROM pages WHERE ' + where, ["%" + t + "%"] * len(columns)):
+                matches[row[0]] = row
+                counts[row[0]] = counts.get(row[0], 0) + 1
+        results = [row for pageid, row in matches.items() if not match_all or counts[pageid] == len(terms)]
+        results.sort(key=lambda row: -counts[row[0]])
+        return results if limit is None else results[:limit]
+
+    def _has_fulltext(self):
+        if self._fulltext is None:
+            self._fulltext = len(self._query(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pages_fts'")) == 1
+        return self._fulltext
+
     def search_id(self,pageid,print_bool=False):
         info = self._get_page_info(pageid)
         if print_bool:
@@ -75,13 +312,10 @@ class Database:
 
     def search_n(self,n,delta_n):
         print("*Search n =",n,"delta_n =",delta_n)
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         interval = [n-delta_n,n+delta_n]
-        c.execute('''select r.pageid,shelf,book,page,r.wave,r.refindex
+        results = self._query('''select r.pageid,shelf,book,page,r.wave,r.refindex
                     from refractiveindex r join pages p on r.pageid = p.pageid
                     where refindex between ? and ? ''',interval)
-        results = c.fetchall()
         if len(results)==0:
             print("No results found.")
         else:
@@ -89,17 +323,14 @@ class Database:
             print("pageid|shelf|book|page|wavelength|n")
             for r in results:
                 print(r)
-        conn.close()
+        return results
 
     def search_k(self,k,delta_k):
         print("*Search k =",k,"delta_k =",delta_k)
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         interval = [k-delta_k,k+delta_k]
-        c.execute('''select e.pageid,shelf,book,page,e.wave,e.coeff
+        results = self._query('''select e.pageid,shelf,book,page,e.wave,e.coeff
                     from extcoeff e join pages p on e.pageid = p.pageid
                     where coeff between ? and ?''',interval)
-        results = c.fetchall()
         if len(results)==0:
             print("No results found.")
         else:
@@ -107,18 +338,15 @@ class Database:
             print("pageid|shelf|book|page|wavelength|k")
             for r in results:
                 print(r)
-        conn.close()
+        return results
 
     def search_nk(self,n,delta_n,k,delta_k):
         print("*Search n =",n,"delta_n =",delta_n,"k =",k,"delta_k =",delta_k)
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         interval = [n-delta_n,n+delta_n,k-delta_k,k+delta_k]
-        c.execute('''select r.pageid, shelf, book, page, r.wave, r.refindex, e.coeff
+        results = self._query('''select r.pageid, shelf, book, page, r.wave, r.refindex, e.coeff
                     from refractiveindex r join extcoeff e on r.pageid = e.pageid and r.wave = e.wave
                     join pages p on r.pageid = p.pageid
                     where refindex between ? and ? and coeff between ? and ?''',interval)
-        results = c.fetchall()
         if len(results)==0:
             print("No results found.")
         else:
@@ -126,40 +354,212 @@ class Database:
             print("pageid|shelf|book|page|wavelength|n|k")
             for r in results:
                 print(r)
-        conn.close()
+        return results
+
+    def find_materials(self, wavelength, n_range=None, k_range=None):
+        """Materials whose n and/or k at a wavelength lies in a range.
+
+        The envelope index narrows the search down to pages with data in the range
+        near the wavelength, only those are loaded and interpolated.
+
+        :param wavelength: wavelength in um
+        :param n_range: (min, max) of the refractive index or None to not filter on n
+        :param k_range: (min, max) of the extinction coefficient or None to not filter on k
+        :return: list of (pageid, shelf, book, page, n, k), n or k is None if not available
+        """
+        if n_range is None and k_range is None:
+            raise ValueError('Give n_range and/or k_range')
+        candidates = self._envelope_candidates(wavelength, [('n', n_range), ('k', k_range)])
+        results = []
+        for pageid, mat in self.get_materials(candidates).items():
+            n = k = None
+            if mat.has_refractive() and mat.refractiveIndex.rangeMin <= wavelength <= mat.refractiveIndex.rangeMax:
+                n = mat.get_refractiveindex(wavelength * 1000)
+            if mat.has_extinction() and mat.extinctionCoefficient.rangeMin <= wavelength <= mat.extinctionCoefficient.rangeMax:
+                k = mat.get_extinctioncoefficient(wavelength * 1000)
+            if n_range is not None and not (n is not None and min(n_range) <= n <= max(n_range)):
+                continue
+            if k_range is not None and not (k is not None and min(k_range) <= k <= max(k_range)):
+                continue
+            info = mat.get_page_info()
+            results.append((pageid, info['shelf'], info['book'], info['page'],
+                            None if n is None else float(n), None if k is None else float(k)))
+        return results
+
+    def _envelope_candidates(self, wavelength, ranges):
+        """Pageids with an envelope box at the wavelength overlapping every given (kind, range)."""
+        candidates = None
+        for kind, interval in ranges:
+            if interval is None:
+                continue
+            try:
+                pageids = set(r[0] for r in self._query('''SELECT DISTINCT pageid FROM envelope
+                            WHERE kind = ? AND wmin <= ? AND wmax >= ? AND vmin <= ? AND vmax >= ?''',
+                            [_envelope_kinds[kind], wavelength, wavelength, max(interval), min(interval)]))
+            except sqlite3.OperationalError:
+                raise Exception('The database has no envelope index, run Database.upgrade() first')
+            candidates = pageids if candidates is None else candidates & pageids
+        return candidates
+
+    def find_dispersion(self, wavelength, group_index_range=None, gvd_range=None, tod_range=None):
+        """Materials whose stored group index, GVD and/or TOD at a wavelength lie in a range.
+
+        Raises an exception if the database was not built with ``dispersion=True``. For example all materials with
+        |GVD| < 50 fs^2/mm at 800 nm are ``find_dispersion(0.8, gvd_range=(-50, 50))``.
+
+        :param wavelength: wavelength in um
+        :param gvd_range: (min, max) in fs^2/mm, tod_range in fs^3/mm, None to not filter
+        :return: list of (pageid, shelf, book, page, group index, GVD, TOD)
+        """
+        ranges = [('group_index', group_index_range), ('gvd', gvd_range), ('tod', tod_range)]
+        if all(interval is None for _, interval in ranges):
+            raise ValueError('Give group_index_range, gvd_range and/or tod_range')
+        if not _has_table(self._connection(), 'dispersion'):
+            raise Exception('The database has no stored dispersion, build it with dispersion=True')
+        candidates = sorted(self._envelope_candidates(wavelength, ranges))
+        results = []
+        for chunk in _chunks(candidates, _max_variables):
+            for pageid, shelf, book, page, dtype, wave, groupindex, gvd, tod in self._query(
+                    '''SELECT pageid, shelf, book, page, dtype, wave, groupindex, gvd, tod
+                    FROM dispersion JOIN pages USING (pageid)
+                    WHERE pageid IN ({}) ORDER BY pageid'''.format(",".join("?" * len(chunk))), chunk):
+                wave = _unpack_array(wave, dtype)
+                values = [float(np.interp(wavelength, wave, _unpack_array(blob, dtype), left=np.nan, right=np.nan))
+                          for blob in (groupindex, gvd, tod)]
+                if all(interval is None or min(interval) <= value <= max(interval)
+                       for (_, interval), value in zip(ranges, values)):
+                    results.append((pageid, shelf, book, page) + tuple(values))
+        return results
+
+    def get_dispersion(self, pageid):
+        """The stored material.Dispersion of a page on its own wavelength grid.
+
+        :return: None if the page has none or the database was built without ``dispersion=True``
+        """
+        try:
+            results = self._query('''SELECT dtype, wave, refindex, groupindex, gvd, tod
+                        FROM dispersion WHERE pageid = ?''', [int(pageid)])
+        except sqlite3.OperationalError:
+            return None
+        if len(results) == 0:
+            return None
+        dtype = results[0][0]
+        return material.Dispersion(*[_unpack_array(blob, dtype) for blob in results[0][1:]])
 
     def get_material(self, pageid):
+        key = _cache_key(pageid)
+        mat = self._cache_get(key)
+        if mat is None:
+            mat = self._load_material(pageid)
+            if mat is not None:
+                self._cache_put(key, mat)
+        return mat
+
+    def _load_material(self, pageid):
         pagedata = self._get_page_info(pageid)
         if pagedata is None:
             print("PageID not found.")
             return None
+        elif self._has_blob_storage():
+            return self._get_material_from_blobs(pagedata)
         else:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            wavelengths_r = None
-            wavelengths_e = None
             refractive = None
             extinction = None
             if pagedata['hasrefractive'] == 1:
-                c.execute('''select wave,refindex
+                refractive = np.array(self._query('''select wave,refindex
                             from refractiveindex
                             where pageid = ?
-                            order by wave asc''', [pageid])
-                results = c.fetchall()
-                wavelengths_r = [r[0] for r in results]
-                refractive = [r[1] for r in results]
+                            order by wave asc''', [pageid]), dtype=float)
             if pagedata['hasextinction'] == 1:
-                c.execute('''select wave,coeff
+                extinction = np.array(self._query('''select wave,coeff
                             from extcoeff
                             where pageid = ?
-                            order by wave asc''', [pageid])
-                results = c.fetchall()
-                wavelengths_e = [r[0] for r in results]
-                extinction = [r[1] for r in results]
-            conn.close()
+                            order by wave asc''', [pageid]), dtype=float)
             # print("Material",pagedata['filepath'],"loaded.")
-            return Material.FromLists(pagedata,wavelengths_r=wavelengths_r,refractive=refractive,
-                                      wavelengths_e=wavelengths_e,extinction=extinction)
+            return Material.FromArrays(pagedata, refractive=refractive, extinction=extinction)
+
+    def get_materials(self, pageids):
+        """Load many materials with a few set based queries instead of one round trip per id.
+
+        :param pageids: iterable of page ids
+        :return: dict pageid -> Material, ids not in the database are left out
+        """
+        materials = OrderedDict()
+        missing = []
+        for pageid in sorted(set(int(i) for i in pageids)):
+            mat = self._cache_get(pageid)
+            if mat is None:
+                missing.append(pageid)
+            else:
+                materials[pageid] = mat
+        loaded = self._load_materials(missing)
+        for pageid, mat in loaded.items():
+            self._cache_put(pageid, mat)
+        materials.update(loaded)
+        return OrderedDict(sorted(materials.items()))
+
+    def _load_materials(self, pageids):
+        materials = OrderedDict()
+        for chunk in _chunks(pageids, _max_variables):
+            placeholders = ",".join("?" * len(chunk))
+            c = self._connection().cursor()
+            c.row_factory = self._page_row
+            c.execute('SELECT * FROM pages WHERE pageid IN ({})'.format(placeholders), chunk)
+            pages = OrderedDict((data['pageid'], data) for data in c.fetchall())
+            c.close()
+            if self._has_blob_storage():
+                for pageid, dtype, wave_r, refindex, wave_e, coeff in self._query(
+                        '''select pageid,dtype,wave_r,refindex,wave_e,coeff
+                        from tabulated
+                        where pageid IN ({})'''.format(placeholders), chunk):
+                    materials[pageid] = Material.FromLists(pages[pageid],
+                                                           wavelengths_r=_unpack_array(wave_r, dtype),
+                                                           refractive=_unpack_array(refindex, dtype),
+                                                           wavelengths_e=_unpack_array(wave_e, dtype),
+                                                           extinction=_unpack_array(coeff, dtype))
+                continue
+            refractive = self._grouped_values('''select pageid,wave,refindex
+                        from refractiveindex
+                        where pageid IN ({})
+                        order by pageid,wave asc'''.format(placeholders), chunk)
+            extinction = self._grouped_values('''select pageid,wave,coeff
+                        from extcoeff
+                        where pageid IN ({})
+                        order by pageid,wave asc'''.format(placeholders), chunk)
+            for pageid, pagedata in pages.items():
+                materials[pageid] = Material.FromArrays(pagedata, refractive=refractive.get(pageid),
+                                                        extinction=extinction.get(pageid))
+        return materials
+
+    def _grouped_values(self, sqlquery, parameters):
+        """Run a (pageid, wave, value) query sorted by pageid and split it into (N, 2) arrays per page."""
+        rows = self._query(sqlquery, parameters)
+        if len(rows) == 0:
+            return {}
+        data = np.fromiter(itertools.chain.from_iterable(rows), dtype=float, count=3 * len(rows)).reshape(-1, 3)
+        ids, starts = np.unique(data[:, 0], return_index=True)
+        groups = np.split(data[:, 1:], starts[1:])
+        # Copies, so a cached material does not keep the array of the whole chunk alive.
+        return {int(i): np.ascontiguousarray(g) for i, g in zip(ids, groups)}
+
+    def _has_blob_storage(self):
+        if self._blob_storage is None:
+            try:
+                self._blob_storage = self._query('SELECT EXISTS (SELECT 1 FROM tabulated)')[0][0] == 1
+            except sqlite3.OperationalError:
+                self._blob_storage = False
+        return self._blob_storage
+
+    def _get_material_from_blobs(self, pagedata):
+        results = self._query('''select dtype,wave_r,refindex,wave_e,coeff
+                    from tabulated
+                    where pageid = ?''', [pagedata['pageid']])
+        dtype, wave_r, refindex, wave_e, coeff = results[0]
+        return Material.FromLists(pagedata,
+                                  wavelengths_r=_unpack_array(wave_r, dtype),
+                                  refractive=_unpack_array(refindex, dtype),
+                                  wavelengths_e=_unpack_array(wave_e, dtype),
+                                  extinction=_unpack_array(coeff, dtype))
 
     def get_material_n_numpy(self,pageid):
         mat = self.get_material(pageid)
@@ -194,46 +594,59 @@ class Database:
             output = folder+os.sep+output
         mat.to_csv(output)
 
-    def get_material_csv_all(self, outputfolder):
-        allids = self._get_all_pageids()
-        for id in allids:
-            print("Processing",id)
-            self.get_material_csv(pageid=id, output="", folder=outputfolder)
+    def get_material_csv_all(self, outputfolder, workers=1):
+        from refractivesqlite import export
+        export.export_csv(self, outputfolder, workers=workers)
+
+    def export_all(self, path, format='csv', pageids=None, workers=1):
+        """Export many pages at once, see refractivesqlite.export.
+
+        :param format: 'csv' (path is a folder), 'parquet' or 'hdf5'
+        """
+        from refractivesqlite import export
+        return export.export(self, path, format=format, pageids=pageids, workers=workers)
+
+    def export_memmap(self, path):
+        """Write the tabulated data to a memory-mapped store, see refractivesqlite.memstore."""
+        from refractivesqlite import memstore
+        memstore.export_memmap(self, path)
+
+    def _get_page_point_counts(self):
+        """Number of n and k samples per page as dict pageid -> (points_r, points_e)."""
+        if self._has_blob_storage():
+            return {r[0]: (r[1], r[2]) for r in self._query('SELECT pageid, points_r, points_e FROM tabulated')}
+        counts = {r[0]: (0, 0) for r in self._query('SELECT pageid FROM pages')}
+        for pageid, points in self._query('SELECT pageid, count(*) FROM refractiveindex GROUP BY pageid'):
+            counts[pageid] = (points, counts[pageid][1])
+        for pageid, points in self._query('SELECT pageid, count(*) FROM extcoeff GROUP BY pageid'):
+            counts[pageid] = (counts[pageid][0], points)
+        return counts
 
     def _get_pages_columns(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('PRAGMA table_info(pages);')
-        results = c.fetchall()
-        names = [r[1] for r in results]
-        conn.close()
-        return names
+        if self._page_columns is None:
+            results = self._query('PRAGMA table_info(pages);')
+            self._page_columns = [r[1] for r in results]
+        return self._page_columns
+
+    def _page_row(self, cursor, row):
+        """Row factory turning a pages row into a dict keyed by the cached column names.
+
+        A plain dict keeps the column order and takes less than half the memory of an
+        OrderedDict, which adds up with one per loaded material.
+        """
+        return dict(zip(self._get_pages_columns(), row))
 
     def _get_page_info(self,pageid):
-        columns = self._get_pages_columns()
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        c = self._connection().cursor()
+        c.row_factory = self._page_row
         c.execute('SELECT * FROM pages WHERE pageid = ?',[pageid])
-        results = c.fetchall()
-        if len(results) == 0:
-            conn.close()
-            return None
-        else:
-            row = results[0]
-            data = OrderedDict.fromkeys(columns)
-            for idx,c in enumerate(columns):
-                data[c] = row[idx]
-            #data = {columns[i]:row[i] for i in range(len(columns))}
-            conn.close()
-            return data
+        data = c.fetchone()
+        c.close()
+        return data
 
     def _get_all_pageids(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT pageid FROM pages')
-        results = c.fetchall()
+        results = self._query('SELECT pageid FROM pages')
         if len(results) == 0:
-            conn.close()
             return None
         else:
             pageids = [row[0] for row in results]
@@ -255,12 +668,128 @@ class Database:
             print("There was a problem with the request.")
             return False
 
-def extract_entry_list(db_path):
+class ResampledTable:
+    """n and k of all pages on one log-spaced wavelength grid.
+
+    ``n`` and ``k`` are (pages, wavelengths) arrays, row i belongs to ``pageids[i]`` and
+    values outside the range of a page are NaN. Columns are read-only views of the blobs.
+    """
+
+    def __init__(self, wavelengths, pageids, n, k):
+        self.wavelengths = wavelengths
+        self.pageids = pageids
+        self.n = n
+        self.k = k
+        self._rows = {int(pageid): i for i, pageid in enumerate(pageids)}
+
+    def row(self, pageid):
+        """Index of a page in the matrices."""
+        return self._rows[int(pageid)]
+
+    def n_at(self, wavelength):
+        """n of all pages at a wavelength in um, linearly interpolated between the grid columns."""
+        return self._at(self.n, wavelength)
+
+    def k_at(self, wavelength):
+        """k of all pages at a wavelength in um, linearly interpolated between the grid columns."""
+        return self._at(self.k, wavelength)
+
+    def _at(self, values, wavelength):
+        w = self.wavelengths
+        if not w[0] <= wavelength <= w[-1]:
+            return np.full(len(self.pageids), np.nan)
+        i = min(int(np.searchsorted(w, wavelength)), len(w) - 1)
+        if w[i] == wavelength or i == 0:
+            return values[:, i]
+        t = (wavelength - w[i - 1]) / (w[i] - w[i - 1])
+        return (1 - t) * values[:, i - 1] + t * values[:, i]
+
+class _ThreadConnection:
+    """The connection of one thread, closed when the thread exits and its local data is freed."""
+    __slots__ = ('conn', 'close', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        # The finalizer must not reference the holder, otherwise it is never collected.
+        self.close = weakref.finalize(self, conn.close)
+
+
+def load_catalog(library_path, cache=True):
+    """Parse library.yml, reusing a JSON copy next to it while the file is unchanged.
+
+    The cache file is ``library.yml.json`` and is invalidated when the modification
+    time or size of library.yml changes. If it cannot be written the catalog is just parsed.
+    The data tree is usually downloaded, so the cache is plain data that cannot run code
+    when it is read, like library.yml itself.
+    """
+    stat = os.stat(library_path)
+    signature = [stat.st_mtime, stat.st_size]
+    cache_path = library_path + ".json"
+    if cache and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            if cached["signature"] == signature:
+                return cached["catalog"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    with open(library_path, "r") as f:
+        catalog = yaml.load(f, Loader=YamlLoader)
+    if cache:
+        try:
+            with open(cache_path, "w") as f:
+                json.dump({"signature": signature, "catalog": catalog}, f)
+        except (OSError, TypeError, ValueError):
+            pass
+    return catalog
+
+def _page_filters(shelf, book, page, covers, has_refractive, has_extinction, exact):
+    """WHERE clause and parameters for Database.query_pages."""
+    clauses = []
+    parameters = []
+    for column, values in (('shelf', shelf), ('book', book), ('page', page)):
+        if values is None:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        clauses.append('(' + ' or '.join([column + ' like ?'] * len(values)) + ')')
+        parameters.extend(v if exact else '%' + v + '%' for v in values)
+    if covers is not None:
+        clauses.append('rangeMin <= ? and rangeMax >= ?')
+        parameters.extend([min(covers), max(covers)])
+    for column, flag in (('hasrefractive', has_refractive), ('hasextinction', has_extinction)):
+        if flag is not None:
+            clauses.append(column + ' = ?')
+            parameters.append(int(bool(flag)))
+    if len(clauses) == 0:
+        return '', parameters
+    return ' WHERE ' + ' and '.join(clauses), parameters
+
+def _cache_key(pageid):
+    try:
+        return int(pageid)
+    except (TypeError, ValueError):
+        return pageid
+
+def _material_nbytes(mat):
+    """Rough memory footprint of a loaded material with its lookup caches, used for the cache budget."""
+    nbytes = 1024 + mat._lookup_nbytes()
+    if mat.packed is not None:
+        return nbytes + mat.packed.nbytes
+    for data in (mat.refractiveIndex, mat.extinctionCoefficient):
+        if data is not None and hasattr(data, 'data'):
+            nbytes += data.data.nbytes
+    return nbytes
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def extract_entry_list(db_path, cache=True):
     entries = []
     referencePath = os.path.normpath(db_path)
     idx = 0
-    with open(os.path.join(referencePath, os.path.normpath("library.yml")), "r") as f:
-        catalog = yaml.safe_load(f)
+    catalog = load_catalog(os.path.join(referencePath, os.path.normpath("library.yml")), cache=cache)
     for sh in catalog:
         shelf = Shelf(sh['SHELF'], sh['name'])
         for b in sh['content']:
@@ -270,7 +799,8 @@ def extract_entry_list(db_path):
                     if 'DIVIDER' not in p:
                         page = Page(p['PAGE'],
                                     p['name'],
-                                    os.path.join(referencePath, os.path.normpath(p['path'])))
+                                    os.path.join(referencePath, os.path.normpath(p['path'])),
+                                    p['path'])
                         entries.append(Entry(str(idx),shelf,book,page))
                         idx+=1
     return entries
@@ -283,59 +813,495 @@ def pretty_entry(entry):
     e = entry
     return ",".join([e.id,e.shelf.shelf,e.book.book,e.page.page])
 
-def create_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=100):
+_schema_version = 6
+
+# Stay below the SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds.
+_max_variables = 500
+
+_storage_layouts = ('rows', 'blobs', 'both')
+_blob_dtype = '<f8'
+
+_pages_table = '''CREATE TABLE {name}
+    (pageid integer PRIMARY KEY, shelf text COLLATE NOCASE, book text COLLATE NOCASE, page text COLLATE NOCASE,
+    filepath text COLLATE NOCASE,
+    hasrefractive integer, hasextinction integer,
+    rangeMin real, rangeMax real, points int,
+    filehash text, mtime real, sourcepath text)'''
+
+_pages_added_columns = [('filehash', 'text'), ('mtime', 'real'), ('sourcepath', 'text')]
+
+_indexes = ['''CREATE INDEX IF NOT EXISTS idx_pages_shelf_book ON pages (shelf, book)''',
+            '''CREATE INDEX IF NOT EXISTS idx_refractiveindex_page ON refractiveindex (pageid, wave, refindex)''',
+            '''CREATE INDEX IF NOT EXISTS idx_refractiveindex_value ON refractiveindex (refindex)''',
+            '''CREATE INDEX IF NOT EXISTS idx_extcoeff_page ON extcoeff (pageid, wave, coeff)''',
+            '''CREATE INDEX IF NOT EXISTS idx_extcoeff_value ON extcoeff (coeff)''']
+
+def _has_indexes(c):
+    """Whether all value indexes exist, they are dropped together with their tables on a rebuild."""
+    names = set(r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    return all(index.split()[5] in names for index in _indexes)
+
+_tabulated_table = '''CREATE TABLE IF NOT EXISTS tabulated
+    (pageid integer PRIMARY KEY, dtype text, points_r int, points_e int,
+    wave_r blob, refindex blob, wave_e blob, coeff blob)'''
+
+_fulltext_columns = ('shelf', 'book', 'page', 'filepath')
+
+_fulltext_table = '''CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5
+    (shelf, book, page, filepath, content='pages', content_rowid='pageid', prefix='2 3')'''
+
+def _build_fulltext_index(c):
+    """(Re)build the FTS5 index over the page names, skipped if SQLite has no FTS5."""
+    try:
+        c.execute(_fulltext_table)
+        c.execute("INSERT INTO pages_fts (pages_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        pass
+
+# Every envelope box covers this many sample intervals of one page.
+_envelope_segment = 32
+
+_envelope_kinds = {'n': 0, 'k': 1, 'group_index': 2, 'gvd': 3, 'tod': 4}
+
+def _create_envelope_table(c):
+    """Bounding boxes in (wavelength, value) of segments of the n and k data of every page.
+
+    An R-tree if SQLite has the module, otherwise a plain table with an index.
+    """
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS envelope USING rtree
+            (id, wmin, wmax, vmin, vmax, +pageid integer, +kind integer)''')
+    except sqlite3.OperationalError:
+        c.execute('''CREATE TABLE IF NOT EXISTS envelope
+            (id integer PRIMARY KEY, wmin real, wmax real, vmin real, vmax real, pageid integer, kind integer)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_envelope ON envelope (kind, wmin, wmax)''')
+
+def _envelope_rows(pageid, kind, data):
+    """Envelope boxes of a (N, 2) array of (wavelength, value) pairs.
+
+    Neighbouring segments share their boundary sample, so a linear interpolation
+    anywhere in the data lies inside one of the boxes.
+    """
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    rows = []
+    for start in range(0, max(len(data) - 1, 1), _envelope_segment):
+        block = data[start:start + _envelope_segment + 1]
+        values = block[:, 1][~np.isnan(block[:, 1])]
+        if len(values) > 0:
+            rows.append([block[0, 0], block[-1, 0], values.min(), values.max(), int(pageid), kind])
+    return rows
+
+def _stored_page_arrays(c):
+    """Yield (pageid, kind, (N, 2) array) for the stored n and k data of all pages."""
+    tabulated = c.execute('SELECT pageid,dtype,wave_r,refindex,wave_e,coeff FROM tabulated').fetchall()
+    for pageid, dtype, wave_r, refindex, wave_e, coeff in tabulated:
+        if refindex is not None:
+            yield pageid, _envelope_kinds['n'], np.column_stack((_unpack_array(wave_r, dtype), _unpack_array(refindex, dtype)))
+        if coeff is not None:
+            yield pageid, _envelope_kinds['k'], np.column_stack((_unpack_array(wave_e, dtype), _unpack_array(coeff, dtype)))
+    if len(tabulated) > 0:
+        return
+    for kind, table, column in ((_envelope_kinds['n'], 'refractiveindex', 'refindex'),
+                                (_envelope_kinds['k'], 'extcoeff', 'coeff')):
+        rows = c.execute('SELECT pageid, wave, {} FROM {} ORDER BY pageid, wave'.format(column, table)).fetchall()
+        for pageid, group in itertools.groupby(rows, key=lambda r: r[0]):
+            yield pageid, kind, np.array([r[1:] for r in group], dtype=float)
+
+_resampled_table = '''CREATE TABLE IF NOT EXISTS resampled
+        (id integer PRIMARY KEY CHECK (id = 0), dtype text, wmin real, wmax real, points integer,
+        pageids blob, refindex blob, coeff blob)'''
+
+# Group index, GVD and TOD of every page on the wavelengths of its n data, sorted by wavelength.
+_dispersion_table = '''CREATE TABLE IF NOT EXISTS dispersion
+    (pageid integer PRIMARY KEY, dtype text, points int,
+    wave blob, refindex blob, groupindex blob, gvd blob, tod blob)'''
+
+def _has_table(c, name):
+    return len(c.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [name]).fetchall()) == 1
+
+def _pack_array(values):
+    if values is None:
+        return None
+    return np.ascontiguousarray(values, dtype=_blob_dtype).tobytes()
+
+def _unpack_array(blob, dtype):
+    # np.frombuffer shares the memory of the blob, no copy is made.
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype=dtype)
+
+def _resample(data, wavelengths):
+    """Linear interpolation of (wavelength, value) pairs on a grid, NaN outside their range."""
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    return np.interp(wavelengths, data[:, 0], data[:, 1], left=np.nan, right=np.nan)
+
+def create_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=100,storage='rows',workers=1,
+                           dispersion=False):
+    """Build the SQLite database from a refractiveindex.info YAML tree.
+
+    :param storage: 'rows' stores one row per wavelength sample in refractiveindex/extcoeff,
+        'blobs' stores the wavelength, n and k arrays of every page as one row of float64 blobs
+        in the tabulated table and 'both' writes both layouts. The value searches
+        (search_n, search_k, search_nk) need the rows layout.
+    :param workers: number of processes parsing the YAML files, None for one per CPU.
+    :param dispersion: also store the group index, GVD and TOD of every page (Material.get_dispersion)
+        in the dispersion table and the envelope index, for Database.find_dispersion and get_dispersion.
+    """
+    if storage not in _storage_layouts:
+        raise ValueError('storage must be one of ' + ', '.join(_storage_layouts))
     conn = sqlite3.connect(new_sqlite_db)
     c = conn.cursor()
     c.execute('''DROP TABLE IF EXISTS pages;''')
     c.execute('''DROP TABLE IF EXISTS refractiveindex;''')
     c.execute('''DROP TABLE IF EXISTS extcoeff;''')
-    c.execute('''CREATE TABLE pages
-    (pageid int, shelf text COLLATE NOCASE, book text COLLATE NOCASE, page text COLLATE NOCASE,
-    filepath text COLLATE NOCASE,
-    hasrefractive integer, hasextinction integer,
-    rangeMin real, rangeMax real, points int)''')
+    c.execute('''DROP TABLE IF EXISTS tabulated;''')
+    c.execute('DROP TABLE IF EXISTS resampled')
+    c.execute('DROP TABLE IF EXISTS dispersion')
+    for virtual_table in ['pages_fts', 'envelope']:
+        try:
+            c.execute('DROP TABLE IF EXISTS ' + virtual_table)
+        except sqlite3.OperationalError:
+            pass
+    # The indexes went with the tables, let upgrade_sqlite_database create them again.
+    c.execute('PRAGMA user_version = 0')
+    c.execute(_pages_table.format(name='pages'))
     c.execute('''CREATE TABLE refractiveindex (pageid int, wave real, refindex real)''')
     c.execute('''CREATE TABLE extcoeff (pageid int, wave real, coeff real)''')
+    c.execute(_tabulated_table)
+    _create_envelope_table(c)
+    if dispersion:
+        c.execute(_dispersion_table)
     conn.commit()
     conn.close()
-    _populate_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=interpolation_points)
+    _populate_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=interpolation_points,
+                              storage=storage,workers=workers,dispersion=dispersion)
+    # Building the indexes after the bulk insert is much faster than maintaining them row by row.
+    upgrade_sqlite_database(new_sqlite_db)
+
+def upgrade_sqlite_database(sqlite_db):
+    """Bring an existing database file in place up to the current schema.
+
+    Databases written by older versions have no primary key on ``pages``, no
+    indexes, no ``tabulated`` table, no source hashes and paths, no full-text index and
+    no envelope index, which is computed from the stored data.
+    The missing columns are added, the pages table is rebuilt with ``pageid``
+    as primary key and the missing indexes and tables are created, so material
+    lookups and searches become index seeks. Running it on an up to date file
+    with all its indexes is a no-op.
+    """
+    conn = sqlite3.connect(sqlite_db)
+    c = conn.cursor()
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    if version >= _schema_version and _has_indexes(c):
+        conn.close()
+        return False
+    columns = c.execute('PRAGMA table_info(pages)').fetchall()
+    names = [r[1] for r in columns]
+    for name, sqltype in _pages_added_columns:
+        if name not in names:
+            c.execute('ALTER TABLE pages ADD COLUMN {} {}'.format(name, sqltype))
+    pk = [r[1] for r in columns if r[5]]
+    if pk != ['pageid']:
+        c.execute(_pages_table.format(name='pages_upgrade'))
+        c.execute('INSERT INTO pages_upgrade SELECT * FROM pages')
+        c.execute('DROP TABLE pages')
+        c.execute('ALTER TABLE pages_upgrade RENAME TO pages')
+    for index in _indexes:
+        c.execute(index)
+    c.execute(_tabulated_table)
+    _build_fulltext_index(c)
+    if not _has_table(c, 'envelope'):
+        _create_envelope_table(c)
+        for pageid, kind, data in _stored_page_arrays(c):
+            c.executemany('INSERT INTO envelope (wmin, wmax, vmin, vmax, pageid, kind) VALUES (?,?,?,?,?,?)',
+                          _envelope_rows(pageid, kind, data))
+    c.execute('ANALYZE')
+    c.execute('PRAGMA user_version = {}'.format(_schema_version))
+    conn.commit()
+    conn.close()
+    return True
+
+_PageData = namedtuple('_PageData', ['entry', 'rangeMin', 'rangeMax', 'points', 'refractive', 'extinction',
+                                     'dispersion', 'filehash', 'mtime', 'error'])
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _evaluate_page(entry, interpolation_points, dispersion=False):
+    """Parse one page YAML file into the arrays stored in the database.
 
-def _populate_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=100):
+    Runs in the worker processes of a parallel build, so it only returns
+    picklable data. Errors are returned instead of raised to be logged by the writer.
+    """
+    try:
+        filehash = _file_hash(entry.page.path)
+        mtime = os.path.getmtime(entry.page.path)
+        mat = material.Material(filename=entry.page.path,interpolation_points=interpolation_points)
+        refr = None
+        ext = None
+        dispersion_data = None
+        if mat.has_refractive():
+            refr = np.asarray(mat.get_complete_refractive(), dtype=_blob_dtype)
+            if dispersion:
+                # Analytic derivatives for formula pages, evaluated on the stored samples.
+                dispersion_data = mat.get_dispersion()
+        if mat.has_extinction():
+            ext = np.asarray(mat.get_complete_extinction(), dtype=_blob_dtype)
+        return _PageData(entry, mat.rangeMin, mat.rangeMax, mat.points, refr, ext, dispersion_data, filehash, mtime,
+                         None)
+    except Exception as error:
+        return _PageData(entry, None, None, None, None, None, None, None, None, error)
+
+
+class _PageWriter:
+    """Single writer for the build, collects pages and inserts them with batched executemany."""
+
+    def __init__(self, cursor, storage, batch_rows=100000):
+        self.c = cursor
+        self.storage = storage
+        self.batch_rows = batch_rows
+        self.pages = []
+        self.refractive = []
+        self.extinction = []
+        self.tabulated = []
+        self.envelope = []
+        self.dispersion = []
+
+    def add(self, data):
+        e = data.entry
+        refr = data.refractive
+        ext = data.extinction
+        if refr is not None:
+            self.envelope.extend(_envelope_rows(e.id, _envelope_kinds['n'], refr))
+        if ext is not None:
+            self.envelope.extend(_envelope_rows(e.id, _envelope_kinds['k'], ext))
+        if data.dispersion is not None:
+            self.add_dispersion(e.id, data.dispersion)
+        if self.storage != 'blobs':
+            if refr is not None:
+                self.refractive.extend([e.id,r[0],r[1]] for r in refr.tolist())
+            if ext is not None:
+                self.extinction.extend([e.id,ex[0],ex[1]] for ex in ext.tolist())
+        if self.storage != 'rows':
+            # Same ordering as the rows layout, which is read back with "order by wave".
+            if refr is not None:
+                refr = refr[np.argsort(refr[:, 0], kind='stable')]
+            if ext is not None:
+                ext = ext[np.argsort(ext[:, 0], kind='stable')]
+            self.tabulated.append([e.id,
+                                   _blob_dtype,
+                                   0 if refr is None else len(refr),
+                                   0 if ext is None else len(ext),
+                                   None if refr is None else _pack_array(refr[:, 0]),
+                                   None if refr is None else _pack_array(refr[:, 1]),
+                                   None if ext is None else _pack_array(ext[:, 0]),
+                                   None if ext is None else _pack_array(ext[:, 1])])
+        self.pages.append([e.id,
+                           e.shelf.shelf,
+                           e.book.book,
+                           e.page.page,
+                           os.sep.join(e.page.path.split(os.sep)[-3:]),
+                           int(refr is not None),
+                           int(ext is not None),
+                           data.rangeMin,
+                           data.rangeMax,
+                           data.points,
+                           data.filehash,
+                           data.mtime,
+                           e.page.source])
+        if len(self.refractive) + len(self.extinction) + len(self.pages) >= self.batch_rows:
+            self.flush()
+
+    def add_dispersion(self, pageid, dispersion):
+        order = np.argsort(dispersion.wavelength, kind='stable')
+        columns = [np.asarray(values, dtype=_blob_dtype)[order] for values in dispersion]
+        for kind, values in zip(['group_index', 'gvd', 'tod'], columns[2:]):
+            self.envelope.extend(_envelope_rows(pageid, _envelope_kinds[kind], np.column_stack((columns[0], values))))
+        self.dispersion.append([pageid, _blob_dtype, len(order)] + [_pack_array(values) for values in columns])
+
+    def flush(self):
+        if len(self.dispersion) > 0:
+            self.c.executemany('INSERT INTO dispersion VALUES (?,?,?,?,?,?,?,?)', self.dispersion)
+        self.c.executemany('INSERT INTO refractiveindex VALUES (?,?,?)', self.refractive)
+        self.c.executemany('INSERT INTO extcoeff VALUES (?,?,?)', self.extinction)
+        self.c.executemany("INSERT INTO tabulated VALUES (?,?,?,?,?,?,?,?)", self.tabulated)
+        self.c.executemany("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", self.pages)
+        self.c.executemany('INSERT INTO envelope (wmin, wmax, vmin, vmax, pageid, kind) VALUES (?,?,?,?,?,?)',
+                           self.envelope)
+        self.pages = []
+        self.envelope = []
+        self.refractive = []
+        self.extinction = []
+        self.tabulated = []
+        self.dispersion = []
+
+
+def _populate_sqlite_database(refractiveindex_db_path,new_sqlite_db,interpolation_points=100,storage='rows',
+                              workers=1,dispersion=False):
+    """Parse all pages and write them to the database.
+
+    With workers > 1 (or None for one per CPU) the pages are parsed in a process pool and
+    written by this process alone. On platforms that spawn processes (Windows) the calling
+    script needs an ``if __name__ == '__main__':`` guard. With dispersion the group index, GVD
+    and TOD are computed in the same pass and written to the dispersion table, which has to exist.
+    """
     entries = extract_entry_list(refractiveindex_db_path)
     conn = sqlite3.connect(new_sqlite_db)
+    # The file is rebuilt from scratch, a crash in the middle means building again anyway.
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    conn.execute('PRAGMA synchronous = OFF')
     c = conn.cursor()
-    for e in entries:
-        try:
-            mat = material.Material(filename=e.page.path,interpolation_points=interpolation_points)
-            hasrefractive=0
-            hasextinction=0
-            if mat.has_refractive():
-                refr = mat.get_complete_refractive()
-                hasrefractive = 1
-                values = [[e.id,r[0],r[1]] for r in refr]
-                c.executemany('INSERT INTO refractiveindex VALUES (?,?,?)', values)
-            if mat.has_extinction():
-                ext = mat.get_complete_extinction()
-                hasextinction = 1
-                values = [[e.id,ex[0],ex[1]] for ex in ext]
-                c.executemany('INSERT INTO extcoeff VALUES (?,?,?)', values)
-            c.execute("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?,?,?)",
-                      [e.id,
-                       e.shelf.shelf,
-                       e.book.book,
-                       e.page.page,
-                       os.sep.join(e.page.path.split(os.sep)[-3:]),
-                       hasrefractive,
-                       hasextinction,
-                       mat.rangeMin,
-                       mat.rangeMax,
-                       mat.points])
-        except Exception as error:
-            print("LOG:",pretty_entry(e),":",error)
+    _write_pages(c, entries, interpolation_points, storage, workers, dispersion)
     conn.commit()
     conn.close()
     print("***Wrote SQLite DB on ",new_sqlite_db)
 
+def _write_pages(c, entries, interpolation_points, storage, workers, dispersion=False):
+    writer = _PageWriter(c, storage)
+
+    def write(results):
+        for data in results:
+            if data.error is None:
+                writer.add(data)
+            else:
+                print("LOG:",pretty_entry(data.entry),":",data.error)
+
+    if workers == 1:
+        write(_evaluate_page(e, interpolation_points, dispersion) for e in entries)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            write(executor.map(_evaluate_page, entries, itertools.repeat(interpolation_points, len(entries)),
+                               itertools.repeat(dispersion, len(entries)), chunksize=16))
+    writer.flush()
+
+def update_sqlite_database(refractiveindex_db_path,sqlite_db,interpolation_points=100,workers=1):
+    """Bring an existing database up to date with a YAML tree, only parsing changed pages.
+
+    Pages are matched on their path in library.yml. A page whose modification time is unchanged is
+    skipped without reading it, otherwise its content hash decides. Changed pages are
+    deleted and inserted again under their old pageid, pages new in library.yml get new
+    pageids and pages no longer listed are removed. The storage layout of the file is kept and
+    the dispersion of the parsed pages is computed if the file has a dispersion table.
+
+    :return: tuple with the number of changed, added and removed pages
+    """
+    upgrade_sqlite_database(sqlite_db)
+    entries = extract_entry_list(refractiveindex_db_path)
+    conn = sqlite3.connect(sqlite_db)
+    c = conn.cursor()
+    has_rows = c.execute('SELECT EXISTS (SELECT 1 FROM refractiveindex) OR EXISTS (SELECT 1 FROM extcoeff)').fetchone()[0]
+    has_blobs = c.execute('SELECT EXISTS (SELECT 1 FROM tabulated)').fetchone()[0]
+    storage = 'both' if has_rows and has_blobs else 'blobs' if has_blobs else 'rows'
+    dispersion = _has_table(c, 'dispersion')
+
+    # Pages written before the source path was stored are matched on the last three
+    # components of their file path, which is only safe while these are unique.
+    existing = {}
+    legacy = {}
+    for pageid, shelf, book, page, filepath, sourcepath, filehash, mtime in c.execute(
+            'SELECT pageid, shelf, book, page, filepath, sourcepath, filehash, mtime FROM pages'):
+        key, pages = (filepath, legacy) if sourcepath is None else (sourcepath, existing)
+        if key in pages:
+            raise Exception('Pages {} and {} have the same path {}, build the database again'.format(
+                pages[key][0], pageid, key))
+        pages[key] = (pageid, (shelf, book, page), filehash, mtime)
+    nextid = max([v[0] for v in list(existing.values()) + list(legacy.values())], default=-1) + 1
+
+    parse = []
+    renamed = []
+    touched = []
+    sourced = []
+    changed = 0
+    listed = set()
+    for e in entries:
+        if e.page.source in listed:
+            raise Exception('{} is listed twice in library.yml'.format(e.page.source))
+        listed.add(e.page.source)
+        filepath = os.sep.join(e.page.path.split(os.sep)[-3:])
+        if e.page.source in existing:
+            pageid, names, filehash, mtime = existing.pop(e.page.source)
+        elif filepath in legacy:
+            pageid, names, filehash, mtime = legacy.pop(filepath)
+            sourced.append([e.page.source, pageid])
+        else:
+            parse.append(e._replace(id=str(nextid)))
+            nextid += 1
+            continue
+        if not os.path.isfile(e.page.path):
+            continue
+        current_mtime = os.path.getmtime(e.page.path)
+        if mtime != current_mtime:
+            if filehash != _file_hash(e.page.path):
+                parse.append(e._replace(id=str(pageid)))
+                changed += 1
+                continue
+            touched.append([current_mtime, pageid])
+        if names != (e.shelf.shelf, e.book.book, e.page.page):
+            renamed.append([e.shelf.shelf, e.book.book, e.page.page, pageid])
+    removed = [[v[0]] for v in list(existing.values()) + list(legacy.values())]
+
+    conn.execute('PRAGMA synchronous = OFF')
+    obsolete = removed + [[int(e.id)] for e in parse]
+    tables = ['pages', 'refractiveindex', 'extcoeff', 'tabulated', 'envelope']
+    if dispersion:
+        tables.append('dispersion')
+    for table in tables:
+        c.executemany('DELETE FROM {} WHERE pageid = ?'.format(table), obsolete)
+    c.executemany('UPDATE pages SET shelf = ?, book = ?, page = ? WHERE pageid = ?', renamed)
+    c.executemany('UPDATE pages SET mtime = ? WHERE pageid = ?', touched)
+    c.executemany('UPDATE pages SET sourcepath = ? WHERE pageid = ?', sourced)
+    _write_pages(c, parse, interpolation_points, storage, workers, dispersion)
+    _build_fulltext_index(c)
+    grid = []
+    if _has_table(c, 'resampled'):
+        grid = c.execute('SELECT points, wmin, wmax FROM resampled').fetchall()
+    conn.commit()
+    conn.close()
+    if len(grid) == 1:
+        resample_sqlite_database(sqlite_db, *grid[0])
+    print("***Updated SQLite DB on ",sqlite_db,":",changed,"changed,",len(parse)-changed,"added,",
+          len(removed),"removed")
+    return changed, len(parse) - changed, len(removed)
+
+
+def resample_sqlite_database(sqlite_db, points=1000, wavelength_min=None, wavelength_max=None):
+    """Interpolate the n and k data of every page on a shared log-spaced wavelength grid.
+
+    The result is stored as two dense (pages, points) matrices in the single row
+    ``resampled`` table, so comparing all materials at one wavelength is a slice instead of
+    an interpolation per material. Read it with Database.get_resampled. The table is
+    rebuilt with the same grid by update_sqlite_database.
+
+    :param wavelength_min: first grid wavelength in um, default the smallest range start
+    :param wavelength_max: last grid wavelength in um, default the largest range end
+    """
+    with Database(sqlite_db, cache_bytes=0) as db:
+        bounds = db._query('SELECT min(rangeMin), max(rangeMax) FROM pages WHERE rangeMin > 0')[0]
+        wavelength_min = bounds[0] if wavelength_min is None else wavelength_min
+        wavelength_max = bounds[1] if wavelength_max is None else wavelength_max
+        pageids = sorted(db._get_all_pageids() or [])
+        wavelengths = np.geomspace(wavelength_min, wavelength_max, points)
+        n = np.full((len(pageids), points), np.nan)
+        k = np.full((len(pageids), points), np.nan)
+        rows = {pageid: i for i, pageid in enumerate(pageids)}
+        for chunk in _chunks(pageids, _max_variables):
+            for pageid, mat in db._load_materials(chunk).items():
+                i = rows[pageid]
+                if mat.has_refractive():
+                    n[i] = _resample(mat.get_complete_refractive(), wavelengths)
+                if mat.has_extinction():
+                    k[i] = _resample(mat.get_complete_extinction(), wavelengths)
+        conn = db._connection()
+        conn.execute(_resampled_table)
+        conn.execute('DELETE FROM resampled')
+        conn.execute('INSERT INTO resampled VALUES (0,?,?,?,?,?,?,?)',
+                     [_blob_dtype, wavelength_min, wavelength_max, points,
+                      np.asarray(pageids, dtype='<i8').tobytes(), _pack_array(n), _pack_array(k)])
+        conn.commit()
+    print("***Resampled", len(pageids), "pages on", points, "wavelengths in", sqlite_db)
+
 
 def pipeline_test():
     #Database.DownloadRIIzip()
@@ -0,0 +1,143 @@
+"""Bulk export of the tabulated data of a database.
+
+The pages are streamed from a single cursor, so memory use does not grow with the
+size of the library, and written with one formatting operation per file (CSV) or as
+columnar data (Parquet, HDF5). pyarrow and h5py are only needed for their format.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+
+import numpy as np
+
+from refractivesqlite.material import write_csv
+
+formats = ('csv', 'parquet', 'hdf5')
+
+
+def _pairs(wave, values, dtype):
+    if values is None:
+        return None
+    return np.column_stack((np.frombuffer(wave, dtype=dtype), np.frombuffer(values, dtype=dtype)))
+
+
+def iter_pages(db, pageids=None):
+    """Yield (page info, (N, 2) n data or None, (N, 2) k data or None) ordered by pageid.
+
+    :param db: refractivesqlite.dboperations.Database
+    :param pageids: pages to export, default all
+    """
+    c = db._connection().cursor()
+    c.row_factory = db._page_row
+    pages = {info['pageid']: info for info in c.execute('SELECT * FROM pages')}
+    c.close()
+    if pageids is not None:
+        selected = set(int(i) for i in pageids)
+        pages = {pageid: info for pageid, info in pages.items() if pageid in selected}
+    if db._has_blob_storage():
+        c = db._connection().execute('SELECT pageid,dtype,wave_r,refindex,wave_e,coeff FROM tabulated ORDER BY pageid')
+        for pageid, dtype, wave_r, refindex, wave_e, coeff in c:
+            if pageid in pages:
+                yield pages[pageid], _pairs(wave_r, refindex, dtype), _pairs(wave_e, coeff, dtype)
+        c.close()
+        return
+    c = db._connection().execute('''SELECT pageid, 0, wave, refindex FROM refractiveindex
+                UNION ALL SELECT pageid, 1, wave, coeff FROM extcoeff
+                ORDER BY 1, 2, 3''')
+    for pageid, rows in itertools.groupby(c, key=lambda r: r[0]):
+        if pageid not in pages:
+            continue
+        data = np.array([r[1:] for r in rows], dtype=float)
+        refr = data[data[:, 0] == 0, 1:]
+        ext = data[data[:, 0] == 1, 1:]
+        yield pages[pageid], refr if len(refr) > 0 else None, ext if len(ext) > 0 else None
+    c.close()
+
+
+def _write_csv_page(args):
+    return write_csv(*args)
+
+
+def export_csv(db, folder, pageids=None, workers=1, fmt='%r'):
+    """Write every page to ``folder`` with the file names of Database.get_material_csv.
+
+    :param workers: number of processes formatting and writing the files
+    :return: number of written files
+    """
+    def jobs():
+        for info, refr, ext in iter_pages(db, pageids):
+            name = ",".join([str(info['pageid']), info['shelf'], info['book'], info['page']]) + ".csv"
+            yield os.path.join(folder, name), refr, ext, fmt
+
+    written = 0
+    if workers == 1:
+        for job in jobs():
+            written += len(_write_csv_page(job))
+    else:
+        pending = jobs()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Submit in slices so that only a bounded number of pages is held in memory.
+            for batch in iter(lambda: list(itertools.islice(pending, 64 * workers)), []):
+                written += sum(len(files) for files in executor.map(_write_csv_page, batch, chunksize=16))
+    print("***Wrote", written, "files to", folder)
+    return written
+
+
+def export_parquet(db, path, pageids=None, batch=200):
+    """Write all data as one long table with the columns pageid, shelf, book, page,
+    quantity ('n' or 'k'), wavelength and value. Every ``batch`` pages are a row group.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([('pageid', pa.int64()), ('shelf', pa.string()), ('book', pa.string()),
+                        ('page', pa.string()), ('quantity', pa.string()), ('wavelength', pa.float64()),
+                        ('value', pa.float64())])
+    pages = iter_pages(db, pageids)
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter(lambda: list(itertools.islice(pages, batch)), []):
+            columns = OrderedDict((name, []) for name in schema.names)
+            for info, refr, ext in chunk:
+                for quantity, data in (('n', refr), ('k', ext)):
+                    if data is None:
+                        continue
+                    for name in ['pageid', 'shelf', 'book', 'page']:
+                        columns[name].append(np.full(len(data), info[name], dtype=object))
+                    columns['quantity'].append(np.full(len(data), quantity, dtype=object))
+                    columns['wavelength'].append(data[:, 0])
+                    columns['value'].append(data[:, 1])
+            if len(columns['value']) == 0:
+                continue
+            arrays = [pa.array(np.concatenate(values), type=schema.field(name).type)
+                      for name, values in columns.items()]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    print("***Wrote", path)
+
+
+def export_hdf5(db, path, pageids=None):
+    """Write one group per pageid with the page info as attributes and the (N, 2)
+    datasets ``n`` and/or ``k``.
+    """
+    import h5py
+    with h5py.File(path, 'w') as f:
+        for info, refr, ext in iter_pages(db, pageids):
+            group = f.create_group(str(info['pageid']))
+            for key, value in info.items():
+                if value is not None:
+                    group.attrs[key] = value
+            if refr is not None:
+                group.create_dataset('n', data=refr)
+            if ext is not None:
+                group.create_dataset('k', data=ext)
+    print("***Wrote", path)
+
+
+def export(db, path, format='csv', pageids=None, workers=1):
+    """Export to a folder of CSV files or a single Parquet or HDF5 file."""
+    if format == 'csv':
+        return export_csv(db, path, pageids=pageids, workers=workers)
+    elif format == 'parquet':
+        return export_parquet(db, path, pageids=pageids)
+    elif format == 'hdf5':
+        return export_hdf5(db, path, pageids=pageids)
+    raise ValueError('format must be one of ' + ', '.join(formats))
@@ -2,11 +2,30 @@ import os
 import yaml
 import sys
 import argparse
+import bisect
+from collections import namedtuple
 import numpy
-import scipy.interpolate
+
+# The libyaml based loader is several times faster, fall back to the pure Python one without it.
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+speed_of_light = 299792458.0
+
+# Samples in the local cubic fits that differentiate tabulated data.
+dispersion_window = 7
+
+# Wavelength in um, group index, GVD in fs^2/mm and TOD in fs^3/mm.
+Dispersion = namedtuple('Dispersion', ['wavelength', 'n', 'group_index', 'gvd', 'tod'])
 
 class Material:
-    """ Material class"""
+    """ Material class
+
+    Tabulated n and k on the same wavelengths are kept in one (N, 3) array ``packed`` of
+    (wavelength, n, k) rows, the n and k data are views of it.
+    """
+    __slots__ = ('refractiveIndex', 'extinctionCoefficient', 'points', 'pageinfo', 'rangeMin', 'rangeMax',
+                 'packed', '_dispersion')
+
     def __init__(self, filename,interpolation_points=100,empty=False):
         """
 
@@ -14,13 +33,15 @@ class Material:
         """
         self.refractiveIndex = None
         self.extinctionCoefficient = None
+        self.packed = None
+        self._dispersion = None
         self.points = interpolation_points
         if empty:
             return
 
         f = open(filename)
         try:
-            material = yaml.safe_load(f)
+            material = yaml.load(f, Loader=YamlLoader)
         except:
             raise Exception('Bad Material YAML File.')
         finally:
@@ -65,10 +86,7 @@ class Material:
                     if self.refractiveIndex is not None:
                         Exception('Bad Material YAML File')
 
-                    self.refractiveIndex = RefractiveIndexData.SetupRefractiveIndex(formula=-1,
-                                                                                    wavelengths=wavelengths,
-                                                                                    values=n)
-                    self.extinctionCoefficient = ExtinctionCoefficientData.SetupExtinctionCoefficient(wavelengths, k)
+                    self._set_packed(numpy.column_stack((wavelengths, n, k)))
             elif (data['type'].split())[0] == 'formula':
 
                 if self.refractiveIndex is not None:
@@ -91,27 +109,33 @@ class Material:
             self.rangeMin = self.extinctionCoefficient.rangeMin
             self.rangeMax = self.extinctionCoefficient.rangeMax
 
-    def get_refractiveindex(self, wavelength):
+    def get_refractiveindex(self, wavelength, out_of_range='raise', interpolation='linear'):
         """
 
-        :param wavelength:
+        :param wavelength: wavelength in nm, a number or an array
+        :param out_of_range: 'raise', 'nan', 'clip' or 'extrapolate', see out_of_range_policies
+        :param interpolation: 'linear' or 'monotone' for tabulated data, see interpolation_kinds
         :return: :raise Exception:
         """
         if self.refractiveIndex is None:
             raise Exception('No refractive index specified for this material')
         else:
-            return self.refractiveIndex.get_refractiveindex(wavelength)
+            return self.refractiveIndex.get_refractiveindex(wavelength, out_of_range=out_of_range,
+                                                            interpolation=interpolation)
 
-    def get_extinctioncoefficient(self, wavelength):
+    def get_extinctioncoefficient(self, wavelength, out_of_range='raise', interpolation='linear'):
         """
 
-        :param wavelength:
+        :param wavelength: wavelength in nm, a number or an array
+        :param out_of_range: 'raise', 'nan', 'clip' or 'extrapolate', see out_of_range_policies
+        :param interpolation: 'linear' or 'monotone', see interpolation_kinds
         :return: :raise NoExtinctionCoefficient:
         """
         if self.extinctionCoefficient is None:
             raise NoExtinctionCoefficient('No extinction coefficient specified for this material')
         else:
-            return self.extinctionCoefficient.get_extinction_coefficient(wavelength)
+            return self.extinctionCoefficient.get_extinction_coefficient(wavelength, out_of_range=out_of_range,
+                                                                         interpolation=interpolation)
 
     def get_complete_extinction(self):
         if self.has_extinction():
@@ -125,6 +149,67 @@ class Material:
         else:
             return None
 
+    @property
+    def wavelengths(self):
+        """Wavelengths (um) of the refractive data, of the extinction data without it."""
+        data = self.get_complete_refractive()
+        if data is None:
+            data = self.get_complete_extinction()
+        return None if data is None else data[:, 0]
+
+    @property
+    def wavelengths_k(self):
+        """Wavelengths (um) of the extinction data."""
+        data = self.get_complete_extinction()
+        return None if data is None else data[:, 0]
+
+    @property
+    def n(self):
+        """Refractive index at :attr:`wavelengths`, a view into the material data."""
+        data = self.get_complete_refractive()
+        return None if data is None else data[:, 1]
+
+    @property
+    def k(self):
+        """Extinction coefficient at :attr:`wavelengths_k`, a view into the material data."""
+        data = self.get_complete_extinction()
+        return None if data is None else data[:, 1]
+
+    def get_dispersion(self, wavelength=None, window=dispersion_window):
+        """Group index, GVD and TOD from the derivatives of n.
+
+        Formula pages are differentiated analytically, tabulated pages with local cubic fits
+        over ``window`` samples (see tabulated_dispersion). The result on the wavelengths of
+        the refractive data is cached.
+
+        :param wavelength: wavelengths in nm, default the wavelengths of the refractive data
+        :return: Dispersion of arrays, NaN outside the range of the data
+        """
+        if self.refractiveIndex is None:
+            raise Exception('No refractive index specified for this material')
+        if wavelength is None and window == dispersion_window and self._dispersion is not None:
+            return self._dispersion
+        if wavelength is None:
+            w = self.get_complete_refractive()[:, 0]
+        else:
+            w = numpy.atleast_1d(numpy.asarray(wavelength, dtype=float)) / 1000.0
+        if isinstance(self.refractiveIndex, FormulaRefractiveIndexData):
+            derivatives = self.refractiveIndex.get_derivatives(w)
+        else:
+            derivatives = self.refractiveIndex.get_derivatives(w, window=window)
+        dispersion = _dispersion(w, derivatives)
+        if wavelength is None and window == dispersion_window:
+            self._dispersion = dispersion = Dispersion(*[_read_only(values) for values in dispersion])
+        return dispersion
+
+    def _lookup_nbytes(self):
+        """Approximate memory of the interpolators, derivatives and dispersion built by lookups."""
+        nbytes = 0 if self._dispersion is None else sum(values.nbytes for values in self._dispersion)
+        for data in (self.refractiveIndex, self.extinctionCoefficient):
+            if data is not None:
+                nbytes += data._lookup_nbytes()
+        return nbytes
+
     def has_refractive(self):
         return self.refractiveIndex is not None
 
@@ -134,49 +219,281 @@ class Material:
     def get_page_info(self):
         return self.pageinfo
 
-    def to_csv(self, output):
-        refr = self.get_complete_refractive()
-        ext = self.get_complete_extinction()
-        #FizzFuzz
-        if self.has_refractive() and self.has_extinction() and len(refr) == len(ext):
-            header = "wl,n,k\n"
-            output_f = open(output.replace(".csv","(nk).csv"),'w')
-            output_f.write(header)
-            for i in range(len(refr)):
-                output_f.write(",".join(list(map(str,[refr[i][0],refr[i][1],ext[i][1]])))+"\n")
-            output_f.close()
-            print("Wrote",output.replace(".csv","(nk).csv"))
-        else:
-            if self.has_refractive():
-                output_f = open(output.replace(".csv","(n).csv"),'w')
-                header = "wl,n\n"
-                output_f.write(header)
-                for i in range(len(refr)):
-                    output_f.write(",".join(list(map(str,[refr[i][0],refr[i][1]])))+"\n")
-                output_f.close()
-                print("Wrote",output.replace(".csv","(n).csv"))
-            if self.has_extinction():
-                output_f = open(output.replace(".csv","(k).csv"),'w')
-                header = "wl,k\n"
-                output_f.write(header)
-                for i in range(len(ext)):
-                    output_f.write(",".join(list(map(str,[ext[i][0],ext[i][1]])))+"\n")
-                output_f.close()
-                print("Wrote",output.replace(".csv","(k).csv"))
+    def to_csv(self, output, fmt='%r'):
+        for path in write_csv(output, self.get_complete_refractive(), self.get_complete_extinction(), fmt=fmt):
+            print("Wrote", path)
+
+    def _set_tabulated(self, refractive, extinction):
+        """Use (N, 2) arrays (or None) as tabulated n and k data."""
+        if refractive is not None:
+            self.refractiveIndex = TabulatedRefractiveIndexData.FromArray(refractive)
+            self.rangeMin = self.refractiveIndex.rangeMin
+            self.rangeMax = self.refractiveIndex.rangeMax
+        if extinction is not None:
+            self.extinctionCoefficient = ExtinctionCoefficientData.FromArray(extinction)
+            self.rangeMin = self.extinctionCoefficient.rangeMin
+            self.rangeMax = self.extinctionCoefficient.rangeMax
+
+    def _set_packed(self, packed):
+        self.packed = _read_only(packed)
+        self._set_tabulated(self.packed[:, :2], self.packed[:, ::2])
 
     @staticmethod
     def FromLists(pageinfo,wavelengths_r=None,refractive=None,wavelengths_e=None,extinction=None):
         mat = Material("",empty=True)
         mat.pageinfo = pageinfo
-        if refractive is not None:
-            mat.refractiveIndex = TabulatedRefractiveIndexData.FromLists(wavelengths_r,refractive)
-            mat.rangeMin = mat.refractiveIndex.rangeMin
-            mat.rangeMax = mat.refractiveIndex.rangeMax
-        if extinction is not None:
-            mat.extinctionCoefficient = ExtinctionCoefficientData.FromLists(wavelengths_e,extinction)
-            mat.rangeMin = mat.extinctionCoefficient.rangeMin
-            mat.rangeMax = mat.extinctionCoefficient.rangeMax
+        if refractive is not None and extinction is not None and _same_wavelengths(wavelengths_r, wavelengths_e):
+            mat._set_packed(numpy.column_stack((numpy.asarray(wavelengths_r, dtype=float),
+                                                numpy.asarray(refractive, dtype=float),
+                                                numpy.asarray(extinction, dtype=float))))
+        else:
+            mat._set_tabulated(None if refractive is None else _as_pairs(wavelengths_r, refractive),
+                               None if extinction is None else _as_pairs(wavelengths_e, extinction))
         return mat
+
+    @staticmethod
+    def FromArrays(pageinfo, refractive=None, extinction=None, pack=True):
+        """Like FromLists with (N, 2) arrays of (wavelength, value) pairs.
+
+        With pack=True n and k on the same wavelengths are copied into one packed array,
+        otherwise the arrays are used without a copy.
+        """
+        mat = Material("", empty=True)
+        mat.pageinfo = pageinfo
+        if pack and refractive is not None and extinction is not None and \
+                _same_wavelengths(refractive[:, 0], extinction[:, 0]):
+            mat._set_packed(numpy.column_stack((refractive, extinction[:, 1])))
+        else:
+            mat._set_tabulated(refractive, extinction)
+        return mat
+
+
+def _read_only(array):
+    """Read-only view of an array. Materials are shared through the cache of Database, so data
+    they return must not be changed in place; copy it first."""
+    view = numpy.asarray(array).view()
+    view.setflags(write=False)
+    return view
+
+
+def _same_wavelengths(wavelengths_r, wavelengths_e):
+    return len(wavelengths_r) == len(wavelengths_e) and numpy.array_equal(wavelengths_r, wavelengths_e)
+
+
+def _as_pairs(wavelengths, values):
+    """(N, 2) float64 array of (wavelength, value) pairs."""
+    return numpy.column_stack((numpy.asarray(wavelengths, dtype=float), numpy.asarray(values, dtype=float)))
+
+
+# What a query does with wavelengths outside the range of the data:
+# raise an exception, return NaN for them, use the value at the nearest end of the range,
+# or extrapolate (linearly from the end points for tabulated data, the formula itself otherwise).
+out_of_range_policies = ('raise', 'nan', 'clip', 'extrapolate')
+
+
+def _outside_range(wavelength, rangeMin, rangeMax, out_of_range):
+    """Mask of the wavelengths (um) outside [rangeMin, rangeMax], raising for the 'raise' policy."""
+    if out_of_range not in out_of_range_policies:
+        raise ValueError('out_of_range must be one of ' + ', '.join(out_of_range_policies))
+    outside = (wavelength < rangeMin) | (wavelength > rangeMax)
+    if out_of_range == 'raise' and numpy.any(outside):
+        raise Exception(
+            'Wavelength {} is out of bounds. Correct range(um): ({}, {})'.format(wavelength[outside], rangeMin,
+                                                                                 rangeMax))
+    return outside
+
+
+# Interpolation between the samples of tabulated data: piecewise linear, or the monotone
+# cubic Hermite interpolation of Fritsch and Carlson, which does not overshoot the data.
+interpolation_kinds = ('linear', 'monotone')
+
+
+class Interpolator:
+    """Interpolation of a table sorted by x, for a number or an array of points.
+
+    A single number is looked up with bisect on a list copy of the table, which avoids
+    the overhead of numpy for one point. Arrays are evaluated with numpy.interp or,
+    for the monotone kind, with numpy.searchsorted.
+    """
+    __slots__ = ('x', 'y', 'kind', '_x', '_y', 'coefficients', '_coefficients')
+
+    def __init__(self, x, y, kind='linear'):
+        if kind not in interpolation_kinds:
+            raise ValueError('kind must be one of ' + ', '.join(interpolation_kinds))
+        if kind == 'monotone' and len(x) > 1 and numpy.any(x[1:] == x[:-1]):
+            # A repeated x has no secant, keep its last sample like the linear kind does right of it.
+            last = numpy.append(x[1:] != x[:-1], True)
+            x, y = x[last], y[last]
+        self.x = x
+        self.y = y
+        self.kind = kind
+        self._x = x.tolist()
+        self._y = y.tolist()
+        if kind == 'monotone' and len(x) > 1:
+            # Row j holds the coefficient of (x - x_i) ** (3 - j) of every segment i.
+            slopes = _monotone_slopes(x, y)
+            h = numpy.diff(x)
+            delta = numpy.diff(y) / h
+            self.coefficients = numpy.array([(slopes[:-1] + slopes[1:] - 2 * delta) / h ** 2,
+                                             (3 * delta - 2 * slopes[:-1] - slopes[1:]) / h,
+                                             slopes[:-1], y[:-1]])
+            self._coefficients = self.coefficients.T.tolist()
+
+    @property
+    def nbytes(self):
+        """Approximate memory of the list copies and coefficients, x and y are not copied."""
+        # Every float in a list is a pointer and a float object.
+        nbytes = 32 * (len(self._x) + len(self._y))
+        coefficients = getattr(self, 'coefficients', None)
+        if coefficients is not None:
+            nbytes += coefficients.nbytes + (64 + 4 * 32) * len(self._coefficients)
+        return nbytes
+
+    def __call__(self, x, out_of_range='raise'):
+        """Values at x, see out_of_range_policies for points outside the table."""
+        if isinstance(x, (float, int)):
+            return self._scalar(float(x), out_of_range)
+        x = numpy.asarray(x, dtype=float)
+        outside = _outside_range(x, self._x[0], self._x[-1], out_of_range)
+        if len(self._x) == 1:
+            values = numpy.full(x.shape, self._y[0])
+        elif self.kind == 'linear':
+            # numpy.interp already uses the end values outside of x, which is the 'clip' policy.
+            values = numpy.interp(x, self.x, self.y)
+        else:
+            values = self._hermite(x, self._segments(x))
+        if numpy.any(outside):
+            if out_of_range == 'clip':
+                values = numpy.where(x < self._x[0], self._y[0], numpy.where(x > self._x[-1], self._y[-1], values))
+            elif out_of_range == 'nan':
+                values = numpy.where(outside, numpy.nan, values)
+            elif out_of_range == 'extrapolate' and len(self._x) > 1:
+                values = numpy.where(x < self._x[0], self._extrapolate(x, 0), values)
+                values = numpy.where(x > self._x[-1], self._extrapolate(x, -2), values)
+        return values[()]
+
+    def _scalar(self, x, out_of_range):
+        xs = self._x
+        if out_of_range not in out_of_range_policies:
+            raise ValueError('out_of_range must be one of ' + ', '.join(out_of_range_policies))
+        if not xs[0] <= x <= xs[-1]:
+            _outside_range(numpy.array([x]), xs[0], xs[-1], out_of_range)
+            if out_of_range == 'nan':
+                return numpy.nan
+            elif out_of_range == 'extrapolate' and len(xs) > 1:
+                return self._extrapolate(x, 0 if x < xs[0] else -2)
+            x = min(max(x, xs[0]), xs[-1])
+        if len(xs) == 1:
+            return self._y[0]
+        i = min(max(bisect.bisect_right(xs, x) - 1, 0), len(xs) - 2)
+        if self.kind == 'monotone':
+            return self._hermite(x, i)
+        h = xs[i + 1] - xs[i]
+        if h == 0:
+            return self._y[i + 1]
+        return self._y[i] + (x - xs[i]) * (self._y[i + 1] - self._y[i]) / h
+
+    def _segments(self, x):
+        """Index i of the segment x_i <= x < x_i+1 of every point, the end segments outside the table."""
+        if x.ndim == 1 and len(x) > len(self._x) and numpy.all(x[1:] >= x[:-1]):
+            # Sorted points like a spectrum: locating the samples among the points is much cheaper.
+            counts = numpy.diff(numpy.searchsorted(x, self.x[1:-1]), prepend=0, append=len(x))
+            return numpy.repeat(numpy.arange(len(self._x) - 1), counts)
+        return numpy.clip(numpy.searchsorted(self.x, x, side='right') - 1, 0, len(self._x) - 2)
+
+    def _hermite(self, x, i):
+        if isinstance(i, int):
+            dx = x - self._x[i]
+            c3, c2, c1, c0 = self._coefficients[i]
+            return ((c3 * dx + c2) * dx + c1) * dx + c0
+        dx = x - self.x.take(i)
+        values = self.coefficients[0].take(i)
+        for c in self.coefficients[1:]:
+            values *= dx
+            values += c.take(i)
+        return values
+
+    def _extrapolate(self, x, i):
+        """Linear continuation of the segment i, i + 1."""
+        xs, ys = self._x, self._y
+        return ys[i] + (x - xs[i]) * (ys[i + 1] - ys[i]) / (xs[i + 1] - xs[i])
+
+
+def _monotone_slopes(x, y):
+    """Slopes at the samples for a monotone cubic Hermite interpolation (Fritsch-Carlson).
+
+    Interior slopes are the weighted harmonic mean of the secants, zero at local extrema.
+    The end slopes use the three point formula limited to keep monotonicity.
+    """
+    h = numpy.diff(x)
+    delta = numpy.diff(y) / h
+    if len(x) == 2:
+        return numpy.full(2, delta[0])
+    slopes = numpy.empty(len(x))
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = numpy.sign(delta[:-1]) * numpy.sign(delta[1:]) > 0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slopes[1:-1] = numpy.where(same_sign, (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:]), 0.0)
+    slopes[0] = _end_slope(h[0], h[1], delta[0], delta[1])
+    slopes[-1] = _end_slope(h[-1], h[-2], delta[-1], delta[-2])
+    return slopes
+
+
+def _end_slope(h0, h1, delta0, delta1):
+    d = ((2 * h0 + h1) * delta0 - h0 * delta1) / (h0 + h1)
+    if numpy.sign(d) != numpy.sign(delta0):
+        return 0.0
+    elif numpy.sign(delta0) != numpy.sign(delta1) and abs(d) > abs(3 * delta0):
+        return 3 * delta0
+    return d
+
+
+def _nm_to_um(wavelength):
+    if isinstance(wavelength, (float, int)):
+        return wavelength / 1000.0
+    return numpy.asarray(wavelength, dtype=float) / 1000.0
+
+
+def _sorted_pairs(data):
+    """data sorted by wavelength, copied only if it is not sorted yet."""
+    if numpy.any(numpy.diff(data[:, 0]) < 0):
+        data = data[numpy.argsort(data[:, 0], kind='stable')]
+    return data
+
+
+def _format_rows(data, fmt):
+    """All rows of a 2d array as comma separated text with a single formatting operation."""
+    line = ",".join([fmt] * data.shape[1]) + "\n"
+    return (line * len(data)) % tuple(data.ravel().tolist())
+
+
+def write_csv(output, refractive=None, extinction=None, fmt='%r'):
+    """Write (wavelength, n) and (wavelength, k) pairs like Material.to_csv.
+
+    Data on the same grid goes to one ``(nk).csv`` file, otherwise n and k are written
+    to ``(n).csv`` and ``(k).csv``.
+
+    :param fmt: printf style format of a single value, the default '%r' is the shortest text that reads
+        back as the same float, e.g. '%.6g' writes smaller files
+    :return: list of the written files
+    """
+    refr = None if refractive is None else numpy.asarray(refractive, dtype=float)
+    ext = None if extinction is None else numpy.asarray(extinction, dtype=float)
+    files = []
+    if refr is not None and ext is not None and len(refr) == len(ext):
+        files.append((output.replace(".csv", "(nk).csv"), "wl,n,k\n", numpy.column_stack((refr, ext[:, 1]))))
+    else:
+        if refr is not None:
+            files.append((output.replace(".csv", "(n).csv"), "wl,n\n", refr))
+        if ext is not None:
+            files.append((output.replace(".csv", "(k).csv"), "wl,k\n", ext))
+    for path, header, data in files:
+        with open(path, 'w') as output_f:
+            output_f.write(header)
+            output_f.write(_format_rows(data, fmt))
+    return [path for path, header, data in files]
+
 #
 # Refractive Index
 #
@@ -209,6 +526,8 @@ class RefractiveIndexData:
 
 class FormulaRefractiveIndexData:
     """Formula RefractiveIndex class"""
+    __slots__ = ('formula', 'rangeMin', 'rangeMax', 'coefficients', 'interpolation_points', '_evaluate',
+                 '_complete', '_derivatives')
 
     def __init__(self, formula, rangeMin, rangeMax, coefficients,interpolation_points):
         """
@@ -223,85 +542,361 @@ class FormulaRefractiveIndexData:
         self.rangeMax = rangeMax
         self.coefficients = coefficients
         self.interpolation_points = interpolation_points
+        self._evaluate = _compile_formula(formula, coefficients)
+        self._complete = None
+        self._derivatives = None
 
-        if formula in [7,8,9]:
-            raise FormulaNotImplemented('Formula '+str(formula)+ ' not yet implemented')
+    def __reduce__(self):
+        # The compiled formula is a closure, pickle the arguments to compile it again.
+        return (FormulaRefractiveIndexData,
+                (self.formula, self.rangeMin, self.rangeMax, self.coefficients, self.interpolation_points))
 
     def get_complete_refractive(self):
-        #print(self.rangeMin, self.rangeMax)
-        wavelength = numpy.linspace(self.rangeMin, self.rangeMax,num=self.interpolation_points)
-        extlist = [[wavelength[i], self.get_refractiveindex(wavelength[i] * 1000)] for i in range(len(wavelength))]
-        #return numpy.array(extlist)
-        return extlist
+        """(interpolation_points, 2) array of (wavelength, n), computed on first use."""
+        if self._complete is None:
+            wavelength = numpy.linspace(self.rangeMin, self.rangeMax, num=self.interpolation_points)
+            self._complete = _read_only(numpy.column_stack((wavelength, self.get_refractiveindex(wavelength * 1000))))
+        return self._complete
 
-    def get_refractiveindex(self, wavelength):
+    def _lookup_nbytes(self):
+        return 0 if self._complete is None else self._complete.nbytes
+
+    def get_derivatives(self, wavelength):
+        """(4, len(wavelength)) array of n and its first three derivatives, NaN outside the range.
+
+        :param wavelength: wavelengths in um
+        """
+        if self._derivatives is None:
+            self._derivatives = _compile_formula_derivatives(self.formula, self.coefficients)
+        w = numpy.atleast_1d(numpy.asarray(wavelength, dtype=float))
+        inside = (w >= self.rangeMin) & (w <= self.rangeMax)
+        derivatives = numpy.full((4, len(w)), numpy.nan)
+        derivatives[:, inside] = self._derivatives(w[inside])
+        return derivatives
+
+    def get_refractiveindex(self, wavelength, out_of_range='raise', interpolation=None):
         """
 
-        :param wavelength:
+        :param wavelength: wavelength in nm, a number or an array
+        :param out_of_range: 'raise', 'nan', 'clip' or 'extrapolate' (evaluate the formula outside its range)
+        :param interpolation: ignored, formulas are evaluated at the wavelength itself
         :return: :raise Exception:
         """
-        wavelength /= 1000.0
-        if self.rangeMin <= wavelength <= self.rangeMax:
-            formula_type = self.formula
-            coefficients = self.coefficients
-            n = 0
-            if formula_type == 1:  # Sellmeier
-                nsq = 1 + coefficients[0]
-                g = lambda c1, c2, w: c1 * (w ** 2) / (w ** 2 - c2 ** 2)
-                for i in range(1, len(coefficients), 2):
-                    nsq += g(coefficients[i], coefficients[i + 1], wavelength)
-                n = numpy.sqrt(nsq)
-            elif formula_type == 2:  # Sellmeier-2
-                nsq = 1 + coefficients[0]
-                g = lambda c1, c2, w: c1 * (w ** 2) / (w ** 2 - c2)
-                for i in range(1, len(coefficients), 2):
-                    nsq += g(coefficients[i], coefficients[i + 1], wavelength)
-                n = numpy.sqrt(nsq)
-            elif formula_type == 3:  # Polynomal
-                g = lambda c1, c2, w: c1 * w ** c2
-                nsq = coefficients[0]
-                for i in range(1, len(coefficients), 2):
-                    nsq += g(coefficients[i], coefficients[i + 1], wavelength)
-                n = numpy.sqrt(nsq)
-            elif formula_type == 4:  # RefractiveIndex.INFO
-                g1 = lambda c1, c2, c3, c4, w: c1 * w ** c2 / (w ** 2 - c3 ** c4)
-                g2 = lambda c1, c2, w: c1 * w ** c2
-                nsq = coefficients[0]
-                for i in range(1, min(8, len(coefficients)), 4):
-                    nsq += g1(coefficients[i], coefficients[i + 1], coefficients[i + 2], coefficients[i + 3],
-                              wavelength)
-                if len(coefficients) > 9:
-                    for i in range(9, len(coefficients), 2):
-                        nsq += g2(coefficients[i], coefficients[i + 1], wavelength)
-                n = numpy.sqrt(nsq)
-            elif formula_type == 5:  # Cauchy
-                g = lambda c1, c2, w: c1 * w ** c2
-                n = coefficients[0]
-                for i in range(1, len(coefficients), 2):
-                    n += g(coefficients[i], coefficients[i + 1], wavelength)
-            elif formula_type == 6:  # Gasses
-                n = 1 + coefficients[0]
-                g = lambda c1, c2, w: c1 / (c2 - w ** (-2))
-                for i in range(1, len(coefficients), 2):
-                    n += g(coefficients[i], coefficients[i + 1], wavelength)
-            elif formula_type == 7:  # Herzberger
-                raise FormulaNotImplemented('Herzberger formula not yet implemented')
-            elif formula_type == 8:  # Retro
-                raise FormulaNotImplemented('Retro formula not yet implemented')
-            elif formula_type == 9:  # Exotic
-                raise FormulaNotImplemented('Exotic formula not yet implemented')
-            else:
-                raise Exception('Bad formula type')
-
-            return n
-        else:
-            raise Exception(
-                'Wavelength {} is out of bounds. Correct range(um): ({}, {})'.format(wavelength, self.rangeMin,
-                                                                                     self.rangeMax))
-
-
-class TabulatedRefractiveIndexData:
+        wavelength = numpy.asarray(wavelength, dtype=float) / 1000.0
+        outside = _outside_range(wavelength, self.rangeMin, self.rangeMax, out_of_range)
+        if out_of_range == 'clip':
+            wavelength = numpy.clip(wavelength, self.rangeMin, self.rangeMax)
+        elif out_of_range == 'nan' and numpy.any(outside):
+            n = numpy.full(wavelength.shape, numpy.nan)
+            n[~outside] = self._evaluate(wavelength[~outside])
+            return n[()]
+        return self._evaluate(wavelength)[()]
+
+
+def _compile_formula(formula, coefficients):
+    """Return the function n(w) of a formula for wavelengths w in um.
+
+    The coefficients are split once into arrays of the term parameters, e.g. (A_i, B_i)
+    for Sellmeier. The sum over the terms is a reduction over a trailing axis, so
+    an array of wavelengths is evaluated without any Python loop.
+    """
+    c = numpy.asarray(coefficients, dtype=float)
+    if formula == 1:  # Sellmeier
+        a, b = c[1::2], c[2::2] ** 2
+
+        def n(w):
+            w2 = w[..., None] ** 2
+            return numpy.sqrt(1 + c[0] + (a * w2 / (w2 - b)).sum(axis=-1))
+    elif formula == 2:  # Sellmeier-2
+        a, b = c[1::2], c[2::2]
+
+        def n(w):
+            w2 = w[..., None] ** 2
+            return numpy.sqrt(1 + c[0] + (a * w2 / (w2 - b)).sum(axis=-1))
+    elif formula == 3:  # Polynomal
+        a, p = c[1::2], c[2::2]
+
+        def n(w):
+            return numpy.sqrt(c[0] + (a * w[..., None] ** p).sum(axis=-1))
+    elif formula == 4:  # RefractiveIndex.INFO
+        g = c[1:9].reshape(-1, 4)
+        a1, p1, b1 = g[:, 0], g[:, 1], g[:, 2] ** g[:, 3]
+        a2, p2 = c[9::2], c[10::2]
+
+        def n(w):
+            wt = w[..., None]
+            return numpy.sqrt(c[0] + (a1 * wt ** p1 / (wt ** 2 - b1)).sum(axis=-1) + (a2 * wt ** p2).sum(axis=-1))
+    elif formula == 5:  # Cauchy
+        a, p = c[1::2], c[2::2]
+
+        def n(w):
+            return c[0] + (a * w[..., None] ** p).sum(axis=-1)
+    elif formula == 6:  # Gasses
+        a, b = c[1::2], c[2::2]
+
+        def n(w):
+            return 1 + c[0] + (a / (b - w[..., None] ** (-2))).sum(axis=-1)
+    elif formula == 7:  # Herzberger
+        c = _padded(c, 6)
+
+        def n(w):
+            l = 1 / (w ** 2 - 0.028)
+            return c[0] + c[1] * l + c[2] * l ** 2 + c[3] * w ** 2 + c[4] * w ** 4 + c[5] * w ** 6
+    elif formula == 8:  # Retro
+        c = _padded(c, 4)
+
+        def n(w):
+            # (n^2-1)/(n^2+2) = C1 + C2 w^2/(w^2-C3) + C4 w^2, solved for n
+            r = c[0] + c[1] * w ** 2 / (w ** 2 - c[2]) + c[3] * w ** 2
+            return numpy.sqrt((1 + 2 * r) / (1 - r))
+    elif formula == 9:  # Exotic
+        c = _padded(c, 6)
+
+        def n(w):
+            return numpy.sqrt(c[0] + c[1] / (w ** 2 - c[2]) + c[3] * (w - c[4]) / ((w - c[4]) ** 2 + c[5]))
+    else:
+        raise Exception('Bad formula type')
+    return n
+
+
+def _padded(coefficients, length):
+    """Coefficients missing at the end of a fixed length formula are zero."""
+    return numpy.concatenate([coefficients, numpy.zeros(max(0, length - len(coefficients)))])
+
+
+# Derivatives of the formulas are computed with truncated Taylor series ("jets"): an array
+# whose first axis holds a function and its first three derivatives with respect to w.
+
+def _jet_mul(a, b):
+    return numpy.array([a[0] * b[0],
+                        a[1] * b[0] + a[0] * b[1],
+                        a[2] * b[0] + 2 * a[1] * b[1] + a[0] * b[2],
+                        a[3] * b[0] + 3 * a[2] * b[1] + 3 * a[1] * b[2] + a[0] * b[3]])
+
+
+def _jet_power(a, p):
+    """a ** p for a constant (or array of) exponent p, by the chain rule."""
+    u = a[0]
+    g1 = p * u ** (p - 1)
+    g2 = p * (p - 1) * u ** (p - 2)
+    g3 = p * (p - 1) * (p - 2) * u ** (p - 3)
+    return numpy.array([u ** p, g1 * a[1], g2 * a[1] ** 2 + g1 * a[2], g3 * a[1] ** 3 + 3 * g2 * a[1] * a[2] + g1 * a[3]])
+
+
+def _jet_div(a, b):
+    return _jet_mul(a, _jet_power(b, -1.0))
+
+
+def _jet_const(a, value):
+    """a + value, value only changes the function itself."""
+    shifted = a[0] + value
+    jet = numpy.empty((4,) + shifted.shape)
+    jet[0] = shifted
+    jet[1:] = a[1:]
+    return jet
+
+
+def _compile_formula_derivatives(formula, coefficients):
+    """Return the function w -> (4, len(w)) array of n and its first three derivatives.
+
+    The formulas are the ones of _compile_formula written with jets, w in um.
+    """
+    c = numpy.asarray(coefficients, dtype=float)
+
+    def variable(w):
+        # Trailing axis for the sum over the terms of a formula.
+        w = w[..., None]
+        return numpy.array([w, numpy.ones_like(w), numpy.zeros_like(w), numpy.zeros_like(w)])
+
+    def total(jet):
+        return jet.sum(axis=-1)
+
+    if formula in (1, 2):  # Sellmeier, Sellmeier-2
+        a = c[1::2]
+        b = c[2::2] ** 2 if formula == 1 else c[2::2]
+
+        def n(w):
+            w2 = _jet_power(variable(w), 2.0)
+            return _jet_power(_jet_const(total(a * _jet_div(w2, _jet_const(w2, -b))), 1 + c[0]), 0.5)
+    elif formula == 3:  # Polynomal
+        a, p = c[1::2], c[2::2]
+
+        def n(w):
+            return _jet_power(_jet_const(total(a * _jet_power(variable(w), p)), c[0]), 0.5)
+    elif formula == 4:  # RefractiveIndex.INFO
+        g = c[1:9].reshape(-1, 4)
+        a1, p1, b1 = g[:, 0], g[:, 1], g[:, 2] ** g[:, 3]
+        a2, p2 = c[9::2], c[10::2]
+
+        def n(w):
+            x = variable(w)
+            first = total(a1 * _jet_div(_jet_power(x, p1), _jet_const(_jet_power(x, 2.0), -b1)))
+            return _jet_power(_jet_const(first + total(a2 * _jet_power(x, p2)), c[0]), 0.5)
+    elif formula == 5:  # Cauchy
+        a, p = c[1::2], c[2::2]
+
+        def n(w):
+            return _jet_const(total(a * _jet_power(variable(w), p)), c[0])
+    elif formula == 6:  # Gasses
+        a, b = c[1::2], c[2::2]
+
+        def n(w):
+            return _jet_const(total(a * _jet_power(_jet_const(-_jet_power(variable(w), -2.0), b), -1.0)), 1 + c[0])
+    elif formula == 7:  # Herzberger
+        c = _padded(c, 6)
+
+        def n(w):
+            x = variable(w)[..., 0]
+            w2 = _jet_power(x, 2.0)
+            l = _jet_power(_jet_const(w2, -0.028), -1.0)
+            return _jet_const(c[1] * l + c[2] * _jet_mul(l, l) + c[3] * w2 + c[4] * _jet_power(x, 4.0) +
+                              c[5] * _jet_power(x, 6.0), c[0])
+    elif formula == 8:  # Retro
+        c = _padded(c, 4)
+
+        def n(w):
+            w2 = _jet_power(variable(w)[..., 0], 2.0)
+            r = _jet_const(c[1] * _jet_div(w2, _jet_const(w2, -c[2])) + c[3] * w2, c[0])
+            return _jet_power(_jet_div(_jet_const(2 * r, 1.0), _jet_const(-r, 1.0)), 0.5)
+    elif formula == 9:  # Exotic
+        c = _padded(c, 6)
+
+        def n(w):
+            x = variable(w)[..., 0]
+            shifted = _jet_const(x, -c[4])
+            resonance = _jet_div(shifted, _jet_const(_jet_mul(shifted, shifted), c[5]))
+            pole = _jet_power(_jet_const(_jet_power(x, 2.0), -c[2]), -1.0)
+            return _jet_power(_jet_const(c[1] * pole + c[3] * resonance, c[0]), 0.5)
+    else:
+        raise Exception('Bad formula type')
+    return n
+
+
+def _local_polynomial_derivatives(x, y, window=dispersion_window):
+    """First three derivatives of samples y(x) on a non-uniform sorted grid.
+
+    A cubic is fitted by least squares to the ``window`` samples around every point (shifted
+    inwards at the ends) and differentiated at the point. With window=4 the cubic interpolates,
+    larger windows smooth noisy data. NaN with fewer than 4 samples.
+
+    :return: (4, len(x)) array of y and its derivatives
+    """
+    size = len(x)
+    window = min(window, size)
+    if window < 4:
+        return numpy.full((4, size), numpy.nan)
+    starts = numpy.clip(numpy.arange(size) - window // 2, 0, size - window)
+    index = starts[:, None] + numpy.arange(window)
+    dx = x[index] - x[:, None]
+    # Scale the offsets of every window to [-1, 1] to keep the normal equations well conditioned.
+    scale = numpy.abs(dx).max(axis=1)
+    vandermonde = (dx / scale[:, None])[..., None] ** numpy.arange(4)
+    transposed = vandermonde.transpose(0, 2, 1)
+    normal = transposed @ vandermonde
+    rhs = transposed @ y[index][..., None]
+    try:
+        fit = numpy.linalg.solve(normal, rhs)[..., 0]
+    except numpy.linalg.LinAlgError:
+        # Repeated wavelengths can leave a window with fewer than 4 distinct points.
+        fit = (numpy.linalg.pinv(normal) @ rhs)[..., 0]
+    factorials = numpy.array([1.0, 1.0, 2.0, 6.0])
+    return (fit * factorials / scale[:, None] ** numpy.arange(4)).T
+
+
+def tabulated_dispersion(wavelength, n, window=dispersion_window):
+    """Dispersion of tabulated n on a sorted, possibly non-uniform grid, see Material.get_dispersion.
+
+    :param wavelength: wavelengths in um
+    """
+    wavelength = numpy.asarray(wavelength, dtype=float)
+    return _dispersion(wavelength, _local_polynomial_derivatives(wavelength, numpy.asarray(n, dtype=float), window))
+
+
+def _dispersion(w, derivatives):
+    """Dispersion from n and its first three derivatives with respect to the wavelength w in um."""
+    n, n1, n2, n3 = derivatives
+    c = speed_of_light
+    # With w in um and the derivatives in 1/um^k, w^3/(2 pi c^2) n2 is in 1e-6 s^2/m = 1e21 fs^2/mm
+    # and w^4/(4 pi^2 c^3) (3 n2 + w n3) in 1e-12 s^3/m = 1e30 fs^3/mm.
+    gvd = w ** 3 / (2 * numpy.pi * c ** 2) * n2 * 1e21
+    tod = -w ** 4 / (4 * numpy.pi ** 2 * c ** 3) * (3 * n2 + w * n3) * 1e30
+    return Dispersion(w, n, n - w * n1, gvd, tod)
+
+
+class _TabulatedData:
+    """(wavelength, value) samples shared by tabulated n and k data.
+
+    Only the array is stored on construction. Sorting and the interpolator are set up
+    on the first point query, so materials that are only plotted or exported never pay for it.
+    """
+    __slots__ = ('data', 'rangeMin', 'rangeMax', '_interpolators', '_derivatives')
+
+    def _setup(self, data):
+        self.data = _read_only(data)
+        self.rangeMin = float(data[:, 0].min())
+        self.rangeMax = float(data[:, 0].max())
+        self._interpolators = None
+        self._derivatives = None
+
+    @property
+    def wavelengths(self):
+        return self.data[:, 0]
+
+    @property
+    def coefficients(self):
+        return self.data[:, 1]
+
+    @classmethod
+    def FromArray(cls, data):
+        obj = cls.__new__(cls)
+        obj._setup(numpy.asarray(data, dtype=float))
+        return obj
+
+    def _interpolator(self, kind):
+        if self._interpolators is None:
+            self._interpolators = {}
+        interpolator = self._interpolators.get(kind)
+        if interpolator is None:
+            data = _sorted_pairs(self.data)
+            interpolator = self._interpolators[kind] = Interpolator(data[:, 0], data[:, 1], kind)
+        return interpolator
+
+    def _interpolate(self, wavelength, out_of_range, interpolation):
+        return self._interpolator(interpolation)(_nm_to_um(wavelength), out_of_range)
+
+    def _lookup_nbytes(self):
+        # tuple() takes the values at once, another thread may add an interpolator meanwhile.
+        nbytes = sum(interpolator.nbytes for interpolator in tuple((self._interpolators or {}).values()))
+        derivatives = self._derivatives
+        if derivatives is not None:
+            nbytes += derivatives[2].nbytes
+            if not numpy.may_share_memory(derivatives[1], self.data):
+                nbytes += derivatives[1].nbytes
+        return nbytes
+
+    def get_derivatives(self, wavelength=None, window=dispersion_window):
+        """(4, len(wavelength)) array of the values and their first three derivatives.
+
+        They are computed once on the samples with local cubic fits (see
+        _local_polynomial_derivatives) and interpolated linearly to other wavelengths,
+        NaN outside the range.
+
+        :param wavelength: wavelengths in um, default the (sorted) samples
+        """
+        if self._derivatives is None or self._derivatives[0] != window:
+            data = _sorted_pairs(self.data)
+            self._derivatives = (window, data[:, 0],
+                                 _read_only(_local_polynomial_derivatives(data[:, 0], data[:, 1], window)))
+        x, derivatives = self._derivatives[1:]
+        if wavelength is None:
+            return derivatives
+        w = numpy.atleast_1d(numpy.asarray(wavelength, dtype=float))
+        return numpy.array([numpy.interp(w, x, d, left=numpy.nan, right=numpy.nan) for d in derivatives])
+
+
+class TabulatedRefractiveIndexData(_TabulatedData):
     """Tabulated RefractiveIndex class"""
+    __slots__ = ()
 
     def __init__(self, wavelengths, values):
         """
@@ -309,47 +904,32 @@ class TabulatedRefractiveIndexData:
         :param wavelengths:
         :param values:
         """
-        self.rangeMin = numpy.min(wavelengths)
-        self.rangeMax = numpy.max(wavelengths)
-
-        if self.rangeMin == self.rangeMax:
-            self.refractiveFunction = values[0]
-        else:
-            self.refractiveFunction = scipy.interpolate.interp1d(wavelengths, values)
-
-        self.wavelengths = wavelengths
-        self.coefficients = values
+        self._setup(_as_pairs(wavelengths, values))
 
     @staticmethod
     def FromLists(wavelengths,values):
         return TabulatedRefractiveIndexData(wavelengths,values)
 
-    def get_refractiveindex(self, wavelength):
+    def get_refractiveindex(self, wavelength, out_of_range='raise', interpolation='linear'):
         """
 
-        :param wavelength:
+        :param wavelength: wavelength in nm, a number or an array
+        :param out_of_range: 'raise', 'nan', 'clip' or 'extrapolate', see out_of_range_policies
+        :param interpolation: 'linear' or 'monotone', see interpolation_kinds
         :return: :raise Exception:
         """
-        wavelength /= 1000.0
-        if self.rangeMin == self.rangeMax and self.rangeMin == wavelength:
-            return self.refractiveFunction
-        elif self.rangeMin <= wavelength <= self.rangeMax and self.rangeMin != self.rangeMax:
-            return self.refractiveFunction(wavelength)
-        else:
-            raise Exception(
-                'Wavelength {} is out of bounds. Correct range(um): ({}, {})'.format(wavelength, self.rangeMin,
-                                                                                     self.rangeMax))
+        return self._interpolate(wavelength, out_of_range, interpolation)
+
     def get_complete_refractive(self):
-        extlist =  [[self.wavelengths[i],self.coefficients[i]] for i in range(len(self.wavelengths))]
-        #return numpy.array(extlist)
-        return extlist
+        return self.data
 
 
 #
 # Extinction Coefficient
 #
-class ExtinctionCoefficientData:
+class ExtinctionCoefficientData(_TabulatedData):
     """ExtinctionCofficient class"""
+    __slots__ = ()
 
     @staticmethod
     def SetupExtinctionCoefficient(wavelengths, values):
@@ -371,29 +951,20 @@ class ExtinctionCoefficientData:
         :param wavelengths:
         :param coefficients:
         """
-        self.extCoeffFunction = scipy.interpolate.interp1d(wavelengths, coefficients)
-        self.rangeMin = numpy.min(wavelengths)
-        self.rangeMax = numpy.max(wavelengths)
-        self.wavelengths = wavelengths
-        self.coefficients = coefficients
+        self._setup(_as_pairs(wavelengths, coefficients))
 
-    def get_extinction_coefficient(self, wavelength):
+    def get_extinction_coefficient(self, wavelength, out_of_range='raise', interpolation='linear'):
         """
 
-        :param wavelength:
+        :param wavelength: wavelength in nm, a number or an array
+        :param out_of_range: 'raise', 'nan', 'clip' or 'extrapolate', see out_of_range_policies
+        :param interpolation: 'linear' or 'monotone', see interpolation_kinds
         :return: :raise Exception:
         """
-        wavelength /= 1000.0
-        if self.rangeMin <= wavelength <= self.rangeMax:
-            return self.extCoeffFunction(wavelength)
-        else:
-            raise Exception(
-                'Wavelength {} is out of bounds. Correct range(um): ({}, {})'.format(wavelength, self.rangeMin,
-                                                                                     self.rangeMax))
+        return self._interpolate(wavelength, out_of_range, interpolation)
+
     def get_complete_extinction(self):
-        extlist =  [[self.wavelengths[i],self.coefficients[i]] for i in range(len(self.wavelengths))]
-        #return numpy.array(extlist)
-        return extlist
+        return self.data
 
 #
 # Custom Exceptions
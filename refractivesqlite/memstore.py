@@ -0,0 +1,129 @@
+"""Read-only memory-mapped copy of the tabulated data of a database.
+
+All pages are laid out in a single float64 ``.npy`` file. Each page is a block of
+(wavelength, n) pairs followed by a block of (wavelength, k) pairs. A JSON file
+next to it holds the page info and the offsets of the blocks. Every process that
+opens the store maps the same file, so the data sits once in the page cache and
+lookups return views into the mapping instead of copies.
+"""
+from collections import OrderedDict
+import json
+import os
+
+import numpy as np
+
+from refractivesqlite.material import Material
+
+
+def _index_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+def export_memmap(db, path, chunk=200):
+    """Write all pages of a Database to ``path`` (.npy) and its index (.json).
+
+    :param db: refractivesqlite.dboperations.Database
+    :param chunk: number of materials loaded at a time
+    """
+    counts = db._get_page_point_counts()
+    pageids = sorted(counts)
+    offsets = {}
+    size = 0
+    for pageid in pageids:
+        points_r, points_e = counts[pageid]
+        offsets[pageid] = [size, points_r, size + 2 * points_r, points_e]
+        size += 2 * (points_r + points_e)
+
+    data = np.lib.format.open_memmap(path, mode='w+', dtype='<f8', shape=(size,))
+    pages = []
+    for start in range(0, len(pageids), chunk):
+        for pageid, mat in db._load_materials(pageids[start:start + chunk]).items():
+            offset_r, points_r, offset_e, points_e = offsets[pageid]
+            if mat.has_refractive():
+                data[offset_r:offset_r + 2 * points_r] = mat.get_complete_refractive().ravel()
+            if mat.has_extinction():
+                data[offset_e:offset_e + 2 * points_e] = mat.get_complete_extinction().ravel()
+            pages.append({'info': mat.get_page_info(), 'offsets': offsets[pageid]})
+    data.flush()
+    del data
+    with open(_index_path(path), 'w') as f:
+        json.dump({'version': 1, 'pages': pages}, f)
+
+
+class MemmapDatabase:
+    """Database compatible reader of a store written by :func:`export_memmap`."""
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception('Database file not found')
+        self.path = path
+        self._data = np.load(path, mmap_mode='r')
+        with open(_index_path(path)) as f:
+            index = json.load(f, object_pairs_hook=OrderedDict)
+        self._pages = OrderedDict((page['info']['pageid'], page) for page in index['pages'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._data = None
+
+    def _block(self, offset, points):
+        if points == 0:
+            return None
+        return self._data[offset:offset + 2 * points].reshape(points, 2)
+
+    def search_id(self, pageid, print_bool=False):
+        page = self._pages.get(int(pageid))
+        info = None if page is None else OrderedDict(page['info'])
+        if print_bool:
+            if info is None:
+                print("PageID not found.")
+            else:
+                print("\t".join(info.keys()))
+                print("\t".join(map(str, info.values())))
+        return info
+
+    def get_material(self, pageid):
+        page = self._pages.get(int(pageid))
+        if page is None:
+            print("PageID not found.")
+            return None
+        offset_r, points_r, offset_e, points_e = page['offsets']
+        refr = self._block(offset_r, points_r)
+        ext = self._block(offset_e, points_e)
+        return Material.FromArrays(OrderedDict(page['info']), refractive=refr, extinction=ext, pack=False)
+
+    def get_materials(self, pageids):
+        materials = OrderedDict()
+        for pageid in sorted(set(int(i) for i in pageids)):
+            if pageid in self._pages:
+                materials[pageid] = self.get_material(pageid)
+        return materials
+
+    def get_material_n_numpy(self, pageid):
+        """(wavelength, n) pairs of a page as a read-only view into the mapping."""
+        page = self._pages.get(int(pageid))
+        if page is None:
+            print("PageID not found.")
+            return None
+        refr = self._block(page['offsets'][0], page['offsets'][1])
+        if refr is None:
+            print("Material has no refractive data.")
+        return refr
+
+    def get_material_k_numpy(self, pageid):
+        """(wavelength, k) pairs of a page as a read-only view into the mapping."""
+        page = self._pages.get(int(pageid))
+        if page is None:
+            print("PageID not found.")
+            return None
+        return self._block(page['offsets'][2], page['offsets'][3])
+
+    def _get_all_pageids(self):
+        if len(self._pages) == 0:
+            return None
+        return list(self._pages)
@@ -0,0 +1,154 @@
+"""Timings for the refractivesqlite build and lookup paths.
+
+Run from the repository root:
+python -m tests.benchmarks <folder with library.yml> <database file>
+"""
+import os
+import sys
+import timeit
+
+import yaml
+
+from refractivesqlite import dboperations as DB
+
+
+def best_of(func, repeat=3, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def benchmark_yaml_loading(ymlpath):
+    entries = DB.extract_entry_list(ymlpath, cache=False)
+    texts = []
+    for e in entries:
+        with open(e.page.path) as f:
+            texts.append(f.read())
+    print("*YAML parsing of", len(texts), "pages")
+    loaders = [('SafeLoader', yaml.SafeLoader), ('CSafeLoader', getattr(yaml, 'CSafeLoader', None))]
+    for name, loader in loaders:
+        if loader is None:
+            print(name, "not available (PyYAML built without libyaml)")
+            continue
+        t = best_of(lambda: [yaml.load(text, Loader=loader) for text in texts])
+        print("{:12s} {:8.3f} ms per page".format(name, 1e3 * t / len(texts)))
+
+    library = os.path.join(ymlpath, "library.yml")
+    DB.load_catalog(library, cache=True)
+    t_parse = best_of(lambda: DB.load_catalog(library, cache=False))
+    t_cache = best_of(lambda: DB.load_catalog(library, cache=True))
+    print("*library.yml: parsed {:8.3f} ms, cached {:8.3f} ms".format(1e3 * t_parse, 1e3 * t_cache))
+
+
+def benchmark_material_loading(dbpath):
+    with DB.Database(dbpath, cache_bytes=0) as db:
+        pageids = db._get_all_pageids()
+        print("*Loading", len(pageids), "materials")
+        t_loop = best_of(lambda: [db.get_material(i) for i in pageids])
+        t_bulk = best_of(lambda: db.get_materials(pageids))
+        print("get_material loop {:8.3f} ms, get_materials {:8.3f} ms".format(1e3 * t_loop, 1e3 * t_bulk))
+
+
+def benchmark_memory(dbpath):
+    """Memory held by all materials of the database loaded at once in one process."""
+    import gc
+    import tracemalloc
+    with DB.Database(dbpath, cache_bytes=0) as db:
+        pageids = db._get_all_pageids()
+        # Warm up the connection and the cached schema so they are not counted.
+        db.get_materials(pageids[:1])
+        gc.collect()
+        tracemalloc.start()
+        materials = db.get_materials(pageids)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("*Memory of", len(materials), "loaded materials")
+        print("held {:8.3f} MB ({:.0f} bytes per material), peak while loading {:8.3f} MB".format(
+            current / 2 ** 20, current / len(materials), peak / 2 ** 20))
+
+
+def benchmark_resampled(dbpath, wavelength=0.8):
+    with DB.Database(dbpath) as db:
+        resampled = db.get_resampled()
+        if resampled is None:
+            print("*No resampled table, run Database.resample() first")
+            return
+        materials = db.get_materials(resampled.pageids)
+
+        def interpolate_each():
+            return [m.get_refractiveindex(1000 * wavelength) for m in materials.values()
+                    if m.has_refractive() and m.refractiveIndex.rangeMin <= wavelength <= m.refractiveIndex.rangeMax]
+
+        print("*n of", len(materials), "materials at", wavelength, "um")
+        t_loop = best_of(interpolate_each)
+        t_slice = best_of(lambda: resampled.n_at(wavelength))
+        print("per material {:8.3f} ms, resampled table {:8.3f} ms".format(1e3 * t_loop, 1e3 * t_slice))
+
+
+def benchmark_interpolation(dbpath, pageid=None):
+    """Built-in Interpolator against scipy for 1, 1e3 and 1e6 points on the largest table."""
+    import numpy as np
+    import scipy.interpolate
+    from refractivesqlite.material import Interpolator
+    with DB.Database(dbpath) as db:
+        if pageid is None:
+            counts = db._get_page_point_counts()
+            pageid = max(counts, key=lambda i: counts[i][0])
+        data = db.get_material(pageid).get_complete_refractive()
+    x, y = data[:, 0], data[:, 1]
+    print("*Interpolation of a table with", len(x), "points (pageid {})".format(pageid))
+    candidates = [('linear', Interpolator(x, y), scipy.interpolate.interp1d(x, y)),
+                  ('monotone', Interpolator(x, y, 'monotone'), scipy.interpolate.PchipInterpolator(x, y))]
+    for points in [1, 10 ** 3, 10 ** 6]:
+        w = float(x[len(x) // 3]) if points == 1 else np.linspace(x[0], x[-1], points)
+        number = 10000 if points == 1 else 1
+        for kind, builtin, reference in candidates:
+            t_builtin = best_of(lambda: builtin(w), number=number)
+            t_scipy = best_of(lambda: reference(w), number=number)
+            print("{:8d} points {:8s} built-in {:10.3f} us, scipy {:10.3f} us".format(
+                points, kind, 1e6 * t_builtin, 1e6 * t_scipy))
+
+
+def benchmark_dispersion(dbpath):
+    """Group index, GVD and TOD of every material with refractive data, first call and cached."""
+    with DB.Database(dbpath) as db:
+        materials = [m for m in db.get_materials(db._get_all_pageids()).values() if m.has_refractive()]
+
+    def compute():
+        for m in materials:
+            m._dispersion = None
+            m.refractiveIndex._derivatives = None
+        return [m.get_dispersion() for m in materials]
+
+    print("*Dispersion of", len(materials), "materials")
+    t_first = best_of(compute)
+    t_cached = best_of(lambda: [m.get_dispersion() for m in materials])
+    print("first {:8.3f} ms, cached {:8.3f} ms".format(1e3 * t_first, 1e3 * t_cached))
+
+
+def benchmark_dispersion_query(dbpath, wavelength=0.8, gvd_range=(-50, 50)):
+    """Screening on |GVD| with the stored dispersion against computing it for every material."""
+    with DB.Database(dbpath) as db:
+        if db.get_dispersion(db._get_all_pageids()[0]) is None:
+            print("*No stored dispersion, build the database with dispersion=True")
+            return
+        materials = [m for m in db.get_materials(db._get_all_pageids()).values() if m.has_refractive()]
+
+        def compute_each():
+            for m in materials:
+                m.refractiveIndex._derivatives = None
+            return [m for m in materials if gvd_range[0] <= m.get_dispersion(1000 * wavelength).gvd[0] <= gvd_range[1]]
+
+        found = len(db.find_dispersion(wavelength, gvd_range=gvd_range))
+        print("*GVD in", gvd_range, "fs^2/mm at", wavelength, "um:", found, "of", len(materials), "materials")
+        t_loop = best_of(compute_each)
+        t_query = best_of(lambda: db.find_dispersion(wavelength, gvd_range=gvd_range))
+        print("per material {:8.3f} ms, find_dispersion {:8.3f} ms".format(1e3 * t_loop, 1e3 * t_query))
+
+
+if __name__ == '__main__':
+    benchmark_yaml_loading(sys.argv[1])
+    benchmark_material_loading(sys.argv[2])
+    benchmark_memory(sys.argv[2])
+    benchmark_resampled(sys.argv[2])
+    benchmark_interpolation(sys.argv[2])
+    benchmark_dispersion(sys.argv[2])
+    benchmark_dispersion_query(sys.argv[2])
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from refractivesqlite.material import (FormulaRefractiveIndexData, Interpolator, Material,
+                                      TabulatedRefractiveIndexData, speed_of_light)
+
+# n at 600 nm, from the formulas of refractiveindex.info written out by hand.
+formulas = [(7, [1.5, 0.003, 0.0001, -0.001, 1e-5, -1e-7], 1.509584679344271),
+            (8, [0.3, 0.05, 0.01, -0.002], 1.6187715658579123),
+            (9, [2.0, 0.01, 0.02, 0.001, 0.1, 0.01], 1.4252490454755475)]
+
+
+@pytest.mark.parametrize("formula, coefficients, n", formulas)
+def test_formula_value(formula, coefficients, n):
+    data = FormulaRefractiveIndexData(formula, 0.4, 1.0, coefficients, 100)
+    assert data.get_refractiveindex(600) == pytest.approx(n, rel=1e-14)
+    assert np.allclose(data.get_refractiveindex(np.array([600, 800]))[0], n, rtol=1e-14)
+
+
+# n = 1.5 + 0.1 w on 0.4-1.0 um, tabulated and as a Cauchy formula, so extrapolation is exact.
+pages = [TabulatedRefractiveIndexData.FromLists([0.4, 0.6, 0.8, 1.0], [1.54, 1.56, 1.58, 1.6]),
+         FormulaRefractiveIndexData(5, 0.4, 1.0, [1.5, 0.1, 1], 100)]
+policies = [('nan', np.nan, [np.nan, 1.57, np.nan]),
+            ('clip', 1.6, [1.54, 1.57, 1.6]),
+            ('extrapolate', 1.62, [1.52, 1.57, 1.62])]
+
+
+@pytest.mark.parametrize("data", pages)
+@pytest.mark.parametrize("out_of_range, scalar, array", policies)
+def test_out_of_range_policies(data, out_of_range, scalar, array):
+    assert np.allclose(data.get_refractiveindex(1200, out_of_range=out_of_range), scalar, equal_nan=True)
+    values = data.get_refractiveindex(np.array([200, 700, 1200]), out_of_range=out_of_range)
+    assert np.allclose(values, array, equal_nan=True)
+
+
+@pytest.mark.parametrize("data", pages)
+def test_out_of_range_raises(data):
+    assert data.get_refractiveindex(700) == pytest.approx(1.57)
+    for wavelength in [1200, np.array([200, 700, 1200])]:
+        with pytest.raises(Exception, match='out of bounds'):
+            data.get_refractiveindex(wavelength)
+    with pytest.raises(ValueError):
+        data.get_refractiveindex(700, out_of_range='wrap')
+
+
+def test_monotone_interpolator_matches_pchip():
+    interpolate = pytest.importorskip("scipy.interpolate")
+    # Non-uniform grid with a flat part and a change of slope sign.
+    x = np.array([0.2, 0.25, 0.4, 0.45, 0.7, 1.0, 1.6, 2.5])
+    y = np.array([1.9, 1.7, 1.6, 1.6, 1.55, 1.58, 1.5, 1.2])
+    points = np.linspace(x[0], x[-1], 1001)
+    reference = interpolate.PchipInterpolator(x, y)
+    monotone = Interpolator(x, y, 'monotone')
+    assert np.allclose(monotone(points), reference(points), rtol=0, atol=1e-14)
+    assert monotone(0.5) == pytest.approx(float(reference(0.5)), abs=1e-14)
+
+    # A repeated wavelength keeps its last sample.
+    with np.errstate(all='raise'):
+        repeated = Interpolator(np.insert(x, 4, 0.7), np.insert(y, 4, 1.9), 'monotone')
+        assert np.allclose(repeated(points), reference(points), rtol=0, atol=1e-14)
+        assert repeated(0.7) == pytest.approx(1.55, abs=1e-14)
+
+
+sellmeier = (1, [0, 0.6961663, 0.0684043, 0.4079426, 0.1162414, 0.8974794, 9.896161], None)
+
+
+@pytest.mark.parametrize("formula, coefficients, n", [sellmeier] + formulas)
+def test_formula_gvd_matches_finite_differences(tmp_path, formula, coefficients, n):
+    path = tmp_path / "page.yml"
+    path.write_text("DATA:\n  - type: formula {}\n    range: 0.4 1.0\n    coefficients: {}\n".format(
+        formula, " ".join(map(str, coefficients))))
+    material = Material(str(path))
+    w = np.array([0.5, 0.6, 0.8])
+    h = 1e-4
+    n_w = [material.get_refractiveindex(1000 * (w + i * h)) for i in (-1, 0, 1)]
+    second = (n_w[0] - 2 * n_w[1] + n_w[2]) / h ** 2
+    gvd = w ** 3 / (2 * np.pi * speed_of_light ** 2) * second * 1e21
+    dispersion = material.get_dispersion(1000 * w)
+    assert np.allclose(dispersion.gvd, gvd, rtol=1e-5, atol=1e-6)
+    assert np.allclose(dispersion.group_index, n_w[1] - w * (n_w[2] - n_w[0]) / (2 * h), rtol=1e-6)
@@ -0,0 +1,45 @@
+import os
+
+from refractivesqlite import dboperations as DB
+
+library = """- SHELF: {shelf}
+  name: "{shelf}"
+  content:
+    - BOOK: Ag
+      name: "Ag"
+      content:
+        - PAGE: Johnson
+          name: "Johnson"
+          path: "{shelf}/main/Ag/Johnson.yml"
+"""
+
+page = """DATA:
+  - type: tabulated nk
+    data: |
+        0.4 0.05 2.0
+        0.8 0.04 5.0
+        1.2 0.03 8.0
+"""
+
+
+def write_tree(folder):
+    # Both pages end in main/Ag/Johnson.yml, only their full paths differ.
+    with open(os.path.join(folder, "library.yml"), "w") as f:
+        f.write("".join(library.format(shelf=shelf) for shelf in ["first", "second"]))
+    for shelf in ["first", "second"]:
+        os.makedirs(os.path.join(folder, shelf, "main", "Ag"))
+        with open(os.path.join(folder, shelf, "main", "Ag", "Johnson.yml"), "w") as f:
+            f.write(page)
+
+
+def test_update_of_unchanged_tree_keeps_pages(tmp_path):
+    write_tree(str(tmp_path))
+    dbpath = str(tmp_path / "refractive.db")
+    DB.create_sqlite_database(str(tmp_path), dbpath)
+    with DB.Database(dbpath) as db:
+        before = db._query('SELECT * FROM pages ORDER BY pageid')
+    assert [r[1] for r in before] == ["first", "second"]
+
+    assert DB.update_sqlite_database(str(tmp_path), dbpath) == (0, 0, 0)
+    with DB.Database(dbpath) as db:
+        assert db._query('SELECT * FROM pages ORDER BY pageid') == before